@@ -15,6 +15,7 @@ import struct
 import subprocess
 import time
 import unicodedata
+import urllib.error
 import urllib.parse
 import urllib.request
 
@@ -30,6 +31,20 @@ def copy(a, b): # or b, a...
 class Error(Exception):
     ...
 
+def timeout(maximum=None):
+    # Seconds left before the current command's deadline, for network calls
+    # Without a deadline this is maximum, where None means no timeout
+    expires = duxlot.budget.expires
+    if expires is None:
+        return maximum
+
+    remaining = expires - duxlot.clock.time()
+    if remaining <= 0:
+        raise Error("Ran out of time")
+    if maximum is not None:
+        return min(remaining, maximum)
+    return remaining
+
 # @@ pre-wrapper for api.text services?
 
 def service(collection):
@@ -47,6 +62,87 @@ def service(collection):
         return decorated
     return decorate
 
+# Single-flight: concurrent identical calls, even from different processes,
+# share one execution. Results are passed through files in flight.directory
+
+flight = duxlot.Storage()
+flight.directory = None
+flight.statistics = {}
+
+def coalesce(key, function):
+    if not flight.directory:
+        return function()
+
+    import fcntl
+    import hashlib
+
+    def count(name):
+        duxlot.counters.add(flight.statistics, "flight-" + name)
+
+    def store(path, result):
+        temporary = "%s.%s" % (path, os.getpid())
+        try:
+            with open(temporary, "wb") as f:
+                pickle.dump(result, f)
+            os.replace(temporary, path)
+        except Exception:
+            try: os.remove(temporary)
+            except OSError: ...
+
+    if not os.path.isdir(flight.directory):
+        os.makedirs(flight.directory, exist_ok=True)
+
+    digest = hashlib.sha1(key.encode("utf-8", "replace")).hexdigest()
+    path = os.path.join(flight.directory, digest)
+    started = time.time()
+
+    with open(path + ".lock", "ab") as lock:
+        try: fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Somebody else is making this call, so wait for their result
+            if duxlot.budget.expires is None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            else:
+                while True:
+                    timeout()
+                    try: fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        time.sleep(0.05)
+                    else:
+                        break
+            try:
+                with open(path + ".result", "rb") as f:
+                    finished, failed, value = pickle.load(f)
+            except Exception:
+                finished = 0
+
+            if finished >= started:
+                count("coalesced")
+                if failed:
+                    raise value
+                return value
+
+        # Otherwise this process leads the flight
+        count("executed")
+        os.utime(path + ".lock")
+        try: value = function()
+        except Exception as err:
+            store(path + ".result", (time.time(), True, err))
+            raise
+        store(path + ".result", (time.time(), False, value))
+
+    # Remove files left over from old flights
+    names = os.listdir(flight.directory)
+    if len(names) > 1024:
+        for name in names:
+            name = os.path.join(flight.directory, name)
+            try:
+                if os.path.getmtime(name) < (started - 300):
+                    os.remove(name)
+            except OSError: ...
+
+    return value
+
 
 ### Module: Clock ###
 
@@ -57,7 +153,7 @@ clock.name = "clock"
 def beats(args):
     out = duxlot.Storage()
 
-    beats = ((time.time() + 3600) % 86400) / 86.4
+    beats = ((duxlot.clock.time() + 3600) % 86400) / 86.4
     out.beats_int = int(math.floor(beats))
     out.beats = "@%03i" % out.beats_int
 
@@ -74,7 +170,7 @@ def date_utc(args):
     if "unixtime" in args:
         dt = datetime.datetime.utcfromtimestamp(args.unixtime)
     else:
-        dt = datetime.datetime.utcnow()
+        dt = datetime.datetime.utcfromtimestamp(duxlot.clock.time())
     return dt.strftime("%Y-%m-%d")
 
 @service(clock)
@@ -83,7 +179,7 @@ def datetime_utc(args):
     if "unixtime" in args:
         dt = datetime.datetime.utcfromtimestamp(args.unixtime)
     else:
-        dt = datetime.datetime.utcnow()
+        dt = datetime.datetime.utcfromtimestamp(duxlot.clock.time())
     return dt.strftime("%Y-%m-%d %H:%M:%S")
 
 @service(clock)
@@ -114,7 +210,7 @@ def format_datetime(args):
     if "unixtime" in args:
         dt = datetime.datetime.utcfromtimestamp(args.unixtime)
     else:
-        dt = datetime.datetime.utcnow()
+        dt = datetime.datetime.utcfromtimestamp(duxlot.clock.time())
 
     delta = datetime.timedelta(seconds=args.offset)
     adjusted = dt + delta
@@ -140,8 +236,14 @@ def npl(args):
     out.server = "ntp1.npl.co.uk"
 
     client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    client.sendto(b'\x1b' + 47 * b'\0', (out.server, 123))
-    data, address = client.recvfrom(1024)
+    client.settimeout(timeout())
+    try:
+        client.sendto(b'\x1b' + 47 * b'\0', (out.server, 123))
+        data, address = client.recvfrom(1024)
+    except socket.timeout:
+        raise Error("No response from %s in time" % out.server)
+    finally:
+        client.close()
 
     if data: 
         buf = struct.unpack('B' * 48, data)
@@ -165,7 +267,7 @@ def npl(args):
 def offset_datetime(args):
     fmt = args("format", "%d %b %Y, %H:%M:%S $TZ")
 
-    now = datetime.datetime.utcnow()
+    now = datetime.datetime.utcfromtimestamp(duxlot.clock.time())
     delta = datetime.timedelta(seconds=args.offset * 3600)
     dt = (now + delta).strftime(fmt)
     if "tz" in args:
@@ -290,7 +392,7 @@ def periods_seconds(args):
 def periods_unixtime(args):
     out = duxlot.Storage()
 
-    out.basetime = time.time()
+    out.basetime = duxlot.clock.time()
     copy(out, clock.periods_seconds(text=args.text))
     out.unixtime = out.basetime + out.seconds
 
@@ -302,7 +404,7 @@ def time_utc(args):
     if "unixtime" in args:
         dt = datetime.datetime.utcfromtimestamp(args.unixtime)
     else:
-        dt = datetime.datetime.utcnow()
+        dt = datetime.datetime.utcfromtimestamp(duxlot.clock.time())
     return dt.strftime("%H:%M:%S")
 
 @service(clock)
@@ -391,7 +493,7 @@ def unix_date(args):
 @service(clock)
 def version_number(args):
     epoch = args("epoch", 2012)
-    now = datetime.datetime.utcnow()
+    now = datetime.datetime.utcfromtimestamp(duxlot.clock.time())
     major = now.year - epoch
     minor = now.month
     patch = now.day
@@ -403,7 +505,7 @@ def yi(args):
     def divide(a, b): 
         return (a / b), (a % b)
 
-    quadraels, remainder = divide(int(time.time()), 1753200)
+    quadraels, remainder = divide(int(duxlot.clock.time()), 1753200)
     raels = quadraels * 4
     extraraels, remainder = divide(remainder, 432000)
     return True if (extraraels == 4) else False
@@ -411,7 +513,7 @@ def yi(args):
 @service(clock)
 def zoneinfo_offset(args):
     out = duxlot.Storage()
-    now = time.time()
+    now = duxlot.clock.time()
     tzinfo = clock.parse_zoneinfo(filename=args.filename)
 
     transition, offset, dst, abbreviation = tzinfo[0]
@@ -944,11 +1046,7 @@ def optflag(args):
         flag = flag[1:]
     return flag, arg
 
-@service(irc)
-def parse_message(args):
-    out = duxlot.Storage()
-    octets = args.octets.rstrip(b'\r\n')
-
+def irc_parse(octets):
     message_match = irc_regex_message.match(octets)
     if not message_match:
         raise Error("Malformed")
@@ -964,13 +1062,14 @@ def parse_message(args):
     if parameters and parameters[-1].startswith(b":"):
         parameters[-1] = parameters[-1][1:]
 
-    out.command = command.decode("ascii", "replace")
+    out = {}
+    out["command"] = command.decode("ascii", "replace")
 
-    out.prefix = {"nick": "", "user": "", "host": ""}
+    out["prefix"] = {"nick": "", "user": "", "host": ""}
     if prefix:
-        out.prefix["nick"] = prefix[0].decode("ascii", "replace")
-        out.prefix["user"] = prefix[1].decode("ascii", "replace")
-        out.prefix["host"] = prefix[2].decode("ascii", "replace")
+        out["prefix"]["nick"] = prefix[0].decode("ascii", "replace")
+        out["prefix"]["user"] = prefix[1].decode("ascii", "replace")
+        out["prefix"]["host"] = prefix[2].decode("ascii", "replace")
 
     def heuristic_decode(param):
         # @@ could get these from config
@@ -981,11 +1080,69 @@ def parse_message(args):
                 continue
         return param.decode("utf-8", "replace")
 
-    out.parameters_octets = parameters
-    out.parameters = [heuristic_decode(p) for p in parameters]
-    out.octets = octets
+    out["parameters_octets"] = parameters
+    out["parameters"] = [heuristic_decode(p) for p in parameters]
+    out["octets"] = octets
     return out
 
+@service(irc)
+def parse_message(args):
+    return duxlot.Storage(irc_parse(args.octets.rstrip(b'\r\n')))
+
+class Message(object):
+    "IRC message that pickles as its raw line, and is parsed when read"
+    __slots__ = ("octets", "count", "stamp", "fields")
+
+    def __init__(self, octets, count=None, stamp=None):
+        self.octets = octets.rstrip(b"\r\n")
+        self.count = count
+        # When the line was received, for latency measurements
+        self.stamp = stamp
+        self.fields = None
+
+    def __reduce__(self):
+        return (Message, (self.octets, self.count, self.stamp))
+
+    def __repr__(self):
+        # The fields, for .parsed-message and logs, after the raw line
+        fields = {"octets": self.octets, "count": self.count}
+        fields.update(self.parse())
+        return repr(fields)
+
+    def parse(self):
+        if self.fields is None:
+            try: self.fields = irc_parse(self.octets)
+            except Error:
+                # Lines without parameters, such as a bare command
+                self.fields = irc_parse(self.octets + b" ")
+                self.fields["octets"] = self.octets
+            self.fields["count"] = self.count
+        return self.fields
+
+    def __getitem__(self, key):
+        if key == "octets":
+            return self.octets
+        if key == "count":
+            return self.count
+        return self.parse()[key]
+
+    def __contains__(self, key):
+        return key in self.parse()
+
+    def __iter__(self):
+        return iter(self.parse())
+
+    def get(self, key, default=None):
+        return self.parse().get(key, default)
+
+    def keys(self):
+        return self.parse().keys()
+
+    def items(self):
+        return self.parse().items()
+
+irc.Message = Message
+
 
 ### Module: Py ###
 
@@ -1027,7 +1184,8 @@ def bing(args):
     lang = args("lang", "en-GB")
     page = web.request(
         url="http://www.bing.com/search",
-        query={"mkt": lang, "q": args.phrase}
+        query={"mkt": lang, "q": args.phrase},
+        compress=True
     )
 
     for url in regex_bing_result.findall(page.text):
@@ -1041,7 +1199,8 @@ def duck(args):
 
     page = web.request(
         url="http://duckduckgo.com/html/",
-        query={"q": args.phrase.replace("!", ""), "kl": "uk-en"}
+        query={"q": args.phrase.replace("!", ""), "kl": "uk-en"},
+        compress=True
     )
 
     match = regex_duck_result.search(page.text)
@@ -1111,14 +1270,17 @@ def manifest(args):
 @service(services)
 def query(args):
     url = services.substitute(**args())
-    page = web.request(
-        url=url,
-        limit=512
-    )
 
-    octets = page.octets.split(b"\n", 1)[0]
-    octets = octets.rstrip(b"\r")
-    return octets.decode("utf-8", "replace")
+    def query():
+        page = web.request(
+            url=url,
+            limit=512
+        )
+
+        octets = page.octets.split(b"\n", 1)[0]
+        octets = octets.rstrip(b"\r")
+        return octets.decode("utf-8", "replace")
+    return coalesce("services.query\n" + url, query)
 
 @service(services)
 def substitute(args):
@@ -2485,7 +2647,8 @@ weather.name = "weather"
 def metar_summary(args):
     url = "http://weather.noaa.gov/pub/data/observations/metar/stations/%s.TXT"
     page = web.request(
-        url=url % args.icao
+        url=url % args.icao,
+        ttl=300
     )
 
     metar = page.text.splitlines().pop()
@@ -2800,6 +2963,249 @@ def metar_summary(args):
 web = duxlot.Storage()
 web.name = "web"
 
+@service(web)
+def cache_count(args):
+    statistics = web.options.cache_statistics
+    duxlot.counters.add(statistics, "web-cache-" + args.name)
+
+@service(web)
+def cache_filename(args):
+    import hashlib
+    digest = hashlib.sha1(args.key.encode("utf-8", "replace")).hexdigest()
+    return os.path.join(web.options.cache_directory, digest)
+
+@service(web)
+def cache_get(args):
+    if not web.options.cache_directory:
+        return None
+
+    filename = web.cache_filename(key=args.key)
+    try:
+        with open(filename, "rb") as f:
+            entry = pickle.load(f)
+    except Exception:
+        return None
+
+    if entry.get("key") != args.key:
+        return None
+
+    # Pruning removes the least recently modified files, so touching the file
+    # on each hit makes that least recently used
+    try: os.utime(filename)
+    except OSError: ...
+    return entry
+
+@service(web)
+def cache_key(args):
+    method = "GET" if args("read", True) else "HEAD"
+    vary = []
+    for name, value in args.headers.items():
+        if name.lower() in web.options.cache_vary:
+            vary.append("%s: %s" % (name.lower(), value))
+    limit = str(args.limit) if ("limit" in args) else "*"
+    # Streamed responses are truncated, so they're cached separately
+    stream = repr((args("until"), args("types")))
+    # Redirects are only followed on request, so those responses differ too
+    follow = "follow" if args("follow") else "-"
+    return "\n".join([method, args.url, limit, stream, follow] + sorted(vary))
+
+@service(web)
+def cache_lifetime(args):
+    # Returns None when the response must not be stored
+    import email.utils
+
+    headers = args.headers
+    directives = {}
+    for directive in headers.get("cache-control", "").lower().split(","):
+        name, _, value = directive.strip().partition("=")
+        if name:
+            directives[name] = value.strip('"')
+
+    # Every user of the bot shares the cache, so private responses are
+    # treated like those that mustn't be stored at all
+    if ("no-store" in directives) or ("private" in directives):
+        return None
+
+    if args.status >= 400:
+        return web.options.cache_negative
+
+    if args("ttl") is not None:
+        return args.ttl
+
+    if "no-cache" in directives:
+        return 0
+
+    if "max-age" in directives:
+        try: return max(0, int(directives["max-age"]))
+        except ValueError:
+            return 0
+
+    if "expires" in headers:
+        expires = email.utils.parsedate_tz(headers["expires"])
+        if not expires:
+            return 0
+        date = email.utils.parsedate_tz(headers.get("date", ""))
+        if date:
+            date = email.utils.mktime_tz(date)
+        else:
+            date = time.time()
+        return max(0, email.utils.mktime_tz(expires) - date)
+
+    return 0
+
+@service(web)
+def cache_prune(args):
+    # Removes the least recently used files until the disk tier is in bounds
+    entries = []
+    try:
+        with os.scandir(web.options.cache_directory) as scan:
+            for item in scan:
+                # Names with a dot are temporary files still being written
+                if "." in item.name:
+                    continue
+                try: info = item.stat()
+                except OSError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, item.path))
+    except OSError:
+        return
+
+    entries.sort(reverse=True)
+    files = len(entries)
+    size = sum(entry[1] for entry in entries)
+    while entries and ((files > web.options.cache_files) or
+                       (size > web.options.cache_size)):
+        mtime, length, path = entries.pop()
+        try: os.remove(path)
+        except OSError:
+            continue
+        files -= 1
+        size -= length
+
+@service(web)
+def cache_put(args):
+    import random
+
+    directory = web.options.cache_directory
+    if not directory:
+        return
+
+    entry = args.entry
+    entry["key"] = args.key
+
+    filename = web.cache_filename(key=args.key)
+    temporary = "%s.%s" % (filename, os.getpid())
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(temporary, "wb") as f:
+            pickle.dump(entry, f)
+        os.replace(temporary, filename)
+    except Exception:
+        # Includes objects that can't be pickled, such as some errors
+        try: os.remove(temporary)
+        except OSError: ...
+        return
+
+    # Scanning the directory costs a stat per file, so only a sample of
+    # writes do it, and the bounds can be overshot by a few files in between
+    if random.random() * web.options.cache_prune < 1:
+        web.cache_prune()
+
+@service(web)
+def cache_statistics(args):
+    out = duxlot.Storage()
+    statistics = web.options.cache_statistics
+    for name in ("hits", "misses", "revalidated", "negative"):
+        setattr(out, name, statistics.get("web-cache-" + name, 0))
+    out.requests = out.hits + out.misses + out.revalidated
+    if out.requests:
+        out.ratio = (out.hits + out.revalidated) / out.requests
+    else:
+        out.ratio = 0.0
+    out.entries = 0
+    if web.options.cache_directory:
+        try: names = os.listdir(web.options.cache_directory)
+        except OSError:
+            names = []
+        out.entries = len([name for name in names if not ("." in name)])
+    return out
+
+@service(web)
+def cached(args):
+    # Arguments are the same as for web.fetch, plus an optional ttl
+    import http.client
+
+    params = args()
+    ttl = params.pop("ttl", None)
+    key = web.cache_key(**params)
+    now = duxlot.clock.time()
+
+    entry = web.cache_get(key=key)
+    if entry is not None:
+        if entry["expires"] > now:
+            if "error" in entry:
+                web.cache_count(name="negative")
+                raise entry["error"]
+            web.cache_count(name="hits")
+            return duxlot.Storage(entry["response"])
+
+        # Stale, but the validators can be used to revalidate
+        if entry.get("etag") or entry.get("modified"):
+            params["headers"] = params["headers"].copy()
+            if entry.get("etag"):
+                params["headers"]["If-None-Match"] = entry["etag"]
+            if entry.get("modified"):
+                params["headers"]["If-Modified-Since"] = entry["modified"]
+
+    try: response = web.fetch(**params)
+    except (urllib.error.URLError, socket.error,
+            http.client.HTTPException) as err:
+        web.cache_count(name="misses")
+        web.cache_put(key=key, entry={
+            "error": err,
+            "expires": now + web.options.cache_negative
+        })
+        raise
+
+    if (response.status == 304) and entry and ("response" in entry):
+        web.cache_count(name="revalidated")
+        stored = entry["response"]
+        for name in ("cache-control", "date", "etag", "expires"):
+            if name in response.headers:
+                stored["headers"][name] = response.headers[name]
+        lifetime = web.cache_lifetime(
+            headers=stored["headers"],
+            status=stored["status"],
+            ttl=ttl
+        )
+        entry["expires"] = now + (lifetime or 0)
+        web.cache_put(key=key, entry=entry)
+        return duxlot.Storage(stored)
+
+    web.cache_count(name="misses")
+    lifetime = web.cache_lifetime(
+        headers=response.headers,
+        status=response.status,
+        ttl=ttl
+    )
+    if lifetime is None:
+        return response
+
+    etag = response.headers.get("etag")
+    modified = response.headers.get("last-modified")
+    if (not lifetime) and not (etag or modified):
+        return response
+
+    if len(response("octets", b"")) <= web.options.cache_maximum:
+        web.cache_put(key=key, entry={
+            "expires": now + lifetime,
+            "etag": etag,
+            "modified": modified,
+            "response": response()
+        })
+    return response
+
 @service(web)
 def construct_url(args):
     out = duxlot.Storage()
@@ -2874,6 +3280,87 @@ def default_user_agent(args):
         return headers
     raise Error("Expected headers")
 
+@service(web)
+def fetch(args):
+    # (str) url, (dict) headers: Required
+    # (bytes) data, (int) limit, (bool) follow, (bool) read: Optional
+    # (bytes) until: Optional, a pattern after which to stop reading
+    # (tuple) types: Optional, mime substrings; others aren't read at all
+    out = duxlot.Storage()
+
+    params = {
+        "url": args.url,
+        "headers": args.headers
+    }
+    if "data" in args:
+        params["data"] = args.data
+
+    req = urllib.request.Request(**params)
+    opened = web.transport(request=req, follow=args("follow"))
+
+    with opened as response:
+        out.status = response.status # int
+        out.url = response.url
+
+        # @@ support duplicates, somehow
+        out.headers = py.dict_lower(dict=response.info(), discard=True)
+
+        if args("types"):
+            mime = web.content_type(headers=out.headers).mime
+            if mime and not any(t in mime for t in args.types):
+                return out
+
+        if args("read", True):
+            try: out.octets = web.read(
+                response=response,
+                limit=args("limit"),
+                until=args("until"),
+                coding=out.headers.get("content-encoding")
+            )
+            except socket.timeout:
+                raise Error("Timed out reading from %s" % args.url)
+
+    return out
+
+@service(web)
+def fixture_filename(args):
+    # (object) request: Required, a urllib.request.Request
+    # (bool) follow: Optional
+    import hashlib
+
+    if not web.options.fixtures_directory:
+        return None
+    request = args.request
+    vary = []
+    for name, value in request.header_items():
+        if name.lower() in web.options.cache_vary:
+            vary.append("%s: %s" % (name.lower(), value))
+    key = "\n".join([request.get_method(), request.full_url,
+        repr(request.data), repr(bool(args("follow")))] + sorted(vary))
+    digest = hashlib.sha1(key.encode("utf-8", "replace")).hexdigest()
+    return os.path.join(web.options.fixtures_directory, digest)
+
+@service(web)
+def fixture_put(args):
+    # (dict) fixture: Required, a response or an error
+    # Other arguments are the same as for web.fixture_filename
+    params = args()
+    fixture = params.pop("fixture")
+    filename = web.fixture_filename(**params)
+    if filename is None:
+        return
+
+    temporary = "%s.%s" % (filename, os.getpid())
+    try:
+        os.makedirs(web.options.fixtures_directory, exist_ok=True)
+        with open(temporary, "wb") as f:
+            pickle.dump(fixture, f)
+        os.replace(temporary, filename)
+    except Exception:
+        # Includes errors that can't be pickled
+        try: os.remove(temporary)
+        except OSError: ...
+
 @service(web)
 def head_summary(args):
     out = duxlot.Storage()
@@ -2924,28 +3411,27 @@ def headers_summary(args):
     return out
 
 @service(web)
-def paste(args):
-    page = web.request(
-        url="http://dpaste.de/api/",
-        data={"content": args.text}
-    )
-    return page.text.strip('"') + "raw/"
+def transport(args):
+    # (object) request: Required, a urllib.request.Request
+    # (bool) follow: Optional
+    # Returns a response like http.client.HTTPResponse, from the transport
+    # named by web.options.transport, which is web.transport_<name>
+    name = "transport_" + web.options.transport
+    if not (name in web):
+        raise Error("Unknown transport: %s" % web.options.transport)
+    return getattr(web, name)(**args())
 
 @service(web)
-def request(args):
-    out = duxlot.Storage()
-    out.request_headers = web.default_user_agent(
-        headers=args("headers", {})
-    )
-
-    out.request_url = web.construct_url(**args()).url
+def transport_live(args):
+    # Arguments are the same as for web.transport
+    request = args.request
 
     class ErrorHandler(urllib.request.HTTPDefaultErrorHandler):
         def http_error_default(self, req, fp, code, msg, hdrs):
             return fp
 
     handlers = [ErrorHandler()]
-    if not ("follow" in args):
+    if not args("follow"):
         class RedirectHandler(urllib.request.HTTPRedirectHandler):
             def redirect_request(self, req, fp, code, msg, hdrs, newurl):
                 return None
@@ -2954,11 +3440,233 @@ def request(args):
     opener = urllib.request.build_opener(*handlers)
     urllib.request.install_opener(opener)
 
+    seconds = timeout()
+    if seconds is None:
+        return urllib.request.urlopen(request)
+
+    try: return urllib.request.urlopen(request, timeout=seconds)
+    except urllib.error.URLError as err:
+        if isinstance(err.reason, socket.timeout):
+            raise Error("Timed out connecting to %s" % request.full_url)
+        raise
+    except socket.timeout:
+        raise Error("Timed out connecting to %s" % request.full_url)
+
+@service(web)
+def transport_record(args):
+    # Arguments are the same as for web.transport
+    # Whole bodies are recorded, still encoded, so that replays can be read
+    # with any limit, and are decompressed and parsed as live responses are
+    import http.client
+
+    try:
+        with web.transport_live(**args()) as response:
+            fixture = {
+                "status": response.status,
+                "url": response.url,
+                "headers": list(response.info().items())
+            }
+            try: fixture["body"] = web.read(
+                response=response,
+                limit=web.options.decompress_maximum
+            )
+            except socket.timeout:
+                raise Error("Timed out reading from %s" % response.url)
+    except (Error, urllib.error.URLError, socket.error,
+            http.client.HTTPException) as err:
+        web.fixture_put(fixture={"error": err}, **args())
+        raise
+
+    web.fixture_put(fixture=fixture, **args())
+    return Fixture(fixture)
+
+@service(web)
+def transport_replay(args):
+    # Arguments are the same as for web.transport
+    filename = web.fixture_filename(**args())
+    try:
+        with open(filename, "rb") as f:
+            fixture = pickle.load(f)
+    except Exception:
+        raise Error("No fixture for %s" % args.request.full_url)
+
+    # Injected, to see how services behave with slow sites and deadlines
+    latency = web.options.fixtures_latency
+    if latency:
+        seconds = timeout()
+        if (seconds is not None) and (seconds < latency):
+            time.sleep(seconds)
+            raise Error("Timed out connecting to %s" % args.request.full_url)
+        time.sleep(latency)
+
+    if "error" in fixture:
+        raise fixture["error"]
+    return Fixture(fixture)
+
+class Fixture(object):
+    "Recorded response, with the parts of HTTPResponse that web.fetch uses"
+
+    def __init__(self, fixture):
+        import io
+
+        self.status = fixture["status"]
+        self.url = fixture["url"]
+        self.headers = fixture["headers"]
+        self.body = io.BytesIO(fixture["body"])
+        self.read = self.body.read
+        self.read1 = self.body.read1
+
+    def info(self):
+        import email.message
+
+        message = email.message.Message()
+        for name, value in self.headers:
+            message[name] = value
+        return message
+
+    def close(self):
+        self.body.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+@service(web)
+def paste(args):
+    page = web.request(
+        url="http://dpaste.de/api/",
+        data={"content": args.text}
+    )
+    return page.text.strip('"') + "raw/"
+
+@service(web)
+def read(args):
+    # (object) response: Required
+    # (int) limit, (bytes) until, (str) coding: Optional
+    import zlib
+
+    response = args.response
+    limit = args("limit")
+    coding = (args("coding") or "").lower()
+    regex = re.compile(args.until) if args("until") else None
+
+    if coding in {"gzip", "x-gzip", "deflate"}:
+        decompressor = None
+        # Always cap the decompressed size, to defuse decompression bombs
+        cap = limit if (limit is not None) else web.options.decompress_maximum
+    else:
+        # Reading in chunks also lets the deadline be checked as we go
+        if (regex is None) and (duxlot.budget.expires is None):
+            if limit is None:
+                octets = response.read()
+            else:
+                octets = response.read(limit)
+            duxlot.budget.fetched += len(octets)
+            return octets
+        coding = None
+        cap = limit
+
+    def decompress(data):
+        nonlocal decompressor
+        nonlocal pending
+        if decompressor is None:
+            # The zlib header is two bytes, which may arrive separately
+            pending += data
+            if data and (len(pending) < 2):
+                return b""
+            data, pending = pending, b""
+            if not data:
+                return b""
+
+            if coding != "deflate":
+                wbits = 16 + zlib.MAX_WBITS
+            elif (len(data) >= 2) and (data[0] & 0x0f == 8) and \
+                    not (((data[0] << 8) + data[1]) % 31):
+                wbits = zlib.MAX_WBITS
+            else:
+                # Some servers send raw deflate without the zlib wrapper
+                wbits = -zlib.MAX_WBITS
+            decompressor = zlib.decompressobj(wbits)
+
+        if data:
+            data = decompressor.unconsumed_tail + data
+            # One more than the room left, so that overflows can be seen
+            try: return decompressor.decompress(data, cap - size + 1)
+            except zlib.error as err:
+                raise Error("Couldn't decompress response: %s" % err)
+        return decompressor.flush()
+
+    chunks = []
+    size = 0
+    tail = b""
+    pending = b""
+
+    while (cap is None) or (size < cap):
+        timeout()
+        if coding or (cap is None):
+            amount = 8192
+        else:
+            amount = min(8192, cap - size)
+
+        raw = response.read1(amount)
+        duxlot.budget.fetched += len(raw)
+        if coding:
+            chunk = decompress(raw)
+            # Compressed input can give no output yet, as with a lone header
+            if raw and (not chunk):
+                continue
+        else:
+            chunk = raw
+        if not chunk:
+            break
+
+        if (cap is not None) and ((size + len(chunk)) > cap):
+            if limit is None:
+                msg = "Response is larger than %s bytes when decompressed"
+                raise Error(msg % cap)
+            chunk = chunk[:cap - size]
+        chunks.append(chunk)
+        size += len(chunk)
+
+        if regex is not None:
+            # Keep a little of the previous chunk in case the pattern spans
+            window = tail + chunk
+            if regex.search(window):
+                break
+            tail = window[-64:]
+
+    return b"".join(chunks)
+
+@service(web)
+def request(args):
+    out = duxlot.Storage()
+    out.request_headers = web.default_user_agent(
+        headers=args("headers", {})
+    )
+    if args("compress", web.options.compress):
+        if not any(k.lower() == "accept-encoding" for k in out.request_headers):
+            out.request_headers["Accept-Encoding"] = "gzip, deflate"
+
+    out.request_url = web.construct_url(**args()).url
+
     params = {
         "url": out.request_url,
-        "headers": out.request_headers
+        "headers": out.request_headers,
+        "follow": "follow" in args
     }
 
+    if "limit" in args:
+        params["limit"] = args.limit
+
+    if args("method") == "HEAD":
+        params["read"] = False
+
+    for name in ("until", "types"):
+        if name in args:
+            params[name] = args(name)
+
     if "data" in args:
         data = args.data
         if isinstance(data, dict):
@@ -2971,28 +3679,31 @@ def request(args):
         else:
             raise Error("Unknown data type: %s" % type(data))
 
-    req = urllib.request.Request(**params)
-    with urllib.request.urlopen(req) as response:
-        out.status = response.status # int
-        out.url = response.url
+    def perform():
+        # Only plain GET and HEAD requests are cached, and only on disk
+        if web.options.cache and web.options.cache_directory and \
+                args("cache", True):
+            return web.cached(ttl=args("ttl"), **params)()
+        return web.fetch(**params)()
 
-        if "method" in args:
-            if args.method == "HEAD":
-                # @@ support duplicates, somehow
-                out.headers = py.dict_lower(dict=response.info(), discard=True)
-            elif args.method == "GET":
-                if not ("limit" in args):
-                    out.octets = response.read()
-                else:
-                    out.octets = response.read(args.limit)
-        else:
-            # @@ support duplicates, somehow
-            # also, this code could probably be refactored
-            out.headers = py.dict_lower(dict=response.info(), discard=True)
-            if not ("limit" in args):
-                out.octets = response.read()
-            else:
-                out.octets = response.read(args.limit)
+    if "data" in params:
+        response = duxlot.Storage(web.fetch(**params)())
+    else:
+        key = "web.request\n" + web.cache_key(**params)
+        response = duxlot.Storage(coalesce(key, perform))
+
+    out.status = response.status
+    out.url = response.url
+
+    if "method" in args:
+        if args.method == "HEAD":
+            out.headers = response.headers
+        elif (args.method == "GET") and ("octets" in response):
+            out.octets = response.octets
+    else:
+        out.headers = response.headers
+        if "octets" in response:
+            out.octets = response.octets
 
     if "headers" in out:
         info = web.content_type(headers=out.headers)
@@ -3046,10 +3757,17 @@ def request(args):
 @service(web)
 def title(args):
     regex_title = re.compile(r"(?ims)<title>(.*?)</title>")
+    kargs = args()
+    kargs.setdefault("ttl", 600)
     page = web.request(
         limit=262144,
-        **args()
+        until=br"(?i)</title\s*>",
+        types=("/html", "/xhtml"),
+        **kargs
     )
+    if not ("text" in page):
+        raise Error("Not an HTML page: %s" % page("mime", "unknown type"))
+
     search = regex_title.search(page.text)
     if search:
         title = search.group(1)
@@ -3059,6 +3777,32 @@ def title(args):
 web.options = duxlot.Storage()
 web.options.default_user_agent = "Mozilla/5.0 (Services)"
 
+# Response cache, kept on disk only, as commands each run in a short lived
+# process. Nothing is cached without a directory. Bounded by files and bytes
+web.options.cache = True
+web.options.cache_directory = None
+web.options.cache_files = 4096
+web.options.cache_size = 67108864
+# One in this many writes checks the bounds
+web.options.cache_prune = 64
+web.options.cache_maximum = 1048576
+web.options.cache_negative = 30
+web.options.cache_statistics = {}
+web.options.cache_vary = {
+    "accept", "accept-language", "authorization", "cookie", "user-agent"
+}
+
+# Compressed transfer is opt-in, per request or here
+web.options.compress = False
+web.options.decompress_maximum = 16777216
+
+# Responses come from web.transport_<name>. The record transport saves
+# fixtures of live responses, and the replay transport serves them, after
+# an optional latency, so that services can be run without the network
+web.options.transport = "live"
+web.options.fixtures_directory = None
+web.options.fixtures_latency = 0
+
 
 ### Module: Wikipedia ###
 
@@ -3140,7 +3884,9 @@ def article(args):
         page = web.request(
             url="https://%s.wikipedia.org/wiki/%s" % 
                 (language, underscored(term)),
-            follow=True
+            follow=True,
+            compress=True,
+            ttl=3600
         )
 
         # @@ it's an int here? huh
@@ -3230,7 +3976,8 @@ def etymology(args):
     page = web.request(
         url="http://etymonline.com/index.php",
         query={"term": args.term},
-        headers={"Referer": "http://www.etymonline.com/"}
+        headers={"Referer": "http://www.etymonline.com/"},
+        ttl=86400
     )
 
     if not "text" in page:
@@ -3408,7 +4155,9 @@ def wiktionary_article(args):
 
     page = web.request(
         url="http://en.wiktionary.org/w/index.php",
-        query={"title": args.word, "printable": "yes"}
+        query={"title": args.word, "printable": "yes"},
+        compress=True,
+        ttl=3600
     )
 
     content = page.text
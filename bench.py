@@ -0,0 +1,870 @@
+# Copyright 2012, Sean B. Palmer
+# Code at http://inamidst.com/duxlot/
+# Apache License 2.0
+
+import json
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+import duxlot
+
+# Save PEP 3122!
+if "." in __name__:
+    from . import api
+    from . import irc
+    from . import metrics
+    from . import ring
+else:
+    import api
+    import irc
+    import metrics
+    import ring
+
+# A benchmark of the per-message cost of the whole pipeline, from the server
+# writing a line to the bot having dispatched it. The bot is run against a
+# scripted local server, as in test/server.py, so no network is needed
+
+def traffic():
+    "Channel chatter built from the test/server.py script"
+    lines = []
+    filename = os.path.join(duxlot.path, "test", "combined.txt")
+    if os.path.isfile(filename):
+        with open(filename, encoding="utf-8") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                # Commands become chatter, as this measures the pipeline only
+                if line.startswith(".") or line.startswith("SAY "):
+                    lines.append(line.lstrip(".").split("SAY ", 1).pop())
+
+    if not lines:
+        lines = ["hello", "see http://inamidst.com/duxlot/", "duxlot: hi"]
+    return lines
+
+def tree(pid):
+    "Map the PIDs of a process and its descendants to CPU ticks, on Linux"
+    children = {}
+    ticks = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try: fields = metrics.stat(name)
+        except (IOError, OSError):
+            continue
+        children.setdefault(int(fields[1]), []).append(int(name))
+        ticks[int(name)] = int(fields[11]) + int(fields[12])
+
+    found = {}
+    pending = [pid]
+    while pending:
+        pid = pending.pop()
+        found[pid] = ticks.get(pid, 0)
+        pending.extend(children.get(pid, []))
+    return found
+
+def stop(pid, exited):
+    """Stop a bot with exited, which returns whether it did, then kill the
+    processes it started, as it doesn't take its manager process down"""
+    pids = tree(pid)
+    if exited():
+        del pids[pid]
+    for pid in pids:
+        try: os.kill(pid, signal.SIGKILL)
+        except OSError:
+            ...
+
+def pace(count, rate, started=None):
+    """Yield count indices at rate per second from started, finishing once the
+    last one's interval is over, so count over the time taken is the rate"""
+    if started is None:
+        started = time.time()
+    for i in range(count):
+        # Sleeps are coarser than high rates, so this sends in short bursts
+        ahead = (started + (i / rate)) - time.time()
+        if ahead > 0.001:
+            time.sleep(ahead)
+        yield i
+    ahead = (started + (count / rate)) - time.time()
+    if ahead > 0:
+        time.sleep(ahead)
+
+def cpu(pid):
+    "Seconds of CPU used by a process and its descendants"
+    return sum(tree(pid).values()) / os.sysconf("SC_CLK_TCK")
+
+def percentiles(latencies):
+    "Exact summary statistics of a list of seconds"
+    if not latencies:
+        return {}
+    latencies = sorted(latencies)
+    def percentile(percent):
+        index = int(round(percent / 100 * (len(latencies) - 1)))
+        return latencies[index]
+    return {
+        "mean": sum(latencies) / len(latencies),
+        "p50": percentile(50),
+        "p95": percentile(95),
+        "p99": percentile(99),
+        "max": latencies[-1]
+    }
+
+class Replies(object):
+    "Matches the bot's replies to the commands that caused them, for latency"
+
+    def __init__(self, window=None):
+        import collections
+        import threading
+
+        # Commands older than window seconds are taken to have no reply
+        self.window = window
+        self.lock = threading.Lock()
+        # Reply target to (nick, sent) of commands still awaiting replies
+        self.pending = collections.defaultdict(collections.deque)
+        self.latencies = []
+        self.unmatched = 0
+        self.expired = 0
+
+    def sent(self, target, nick, stamp=None):
+        "Note a command from nick, which the bot will reply to in target"
+        with self.lock:
+            self.pending[target].append((nick, stamp or time.time()))
+
+    def received(self, target, text, stamp=None):
+        received = stamp or time.time()
+        with self.lock:
+            pending = self.pending.get(target)
+            if (self.window is not None) and pending:
+                while pending and ((received - pending[0][1]) > self.window):
+                    pending.popleft()
+                    self.expired += 1
+            if not pending:
+                self.unmatched += 1
+                return
+
+            # Replies start with the nick, but says don't, so use the oldest
+            chosen = 0
+            if ": " in text:
+                nick = text.split(": ", 1)[0]
+                for index, (sender, sent) in enumerate(pending):
+                    if sender == nick:
+                        chosen = index
+                        break
+            nick, sent = pending[chosen]
+            del pending[chosen]
+        self.latencies.append(received - sent)
+
+    def unanswered(self):
+        with self.lock:
+            return self.expired + sum(len(q) for q in self.pending.values())
+
+    def results(self):
+        return {
+            "replies": len(self.latencies),
+            "unanswered": self.unanswered(),
+            "unmatched": self.unmatched,
+            "latency": percentiles(self.latencies)
+        }
+
+class Session(socketserver.StreamRequestHandler):
+    """The server side of one bot connection, for test/load.py and
+    test/replay.py. Subclasses send lines to the bot in play, returning
+    results with at least "lines" and "commands", and see what it says in
+    heard. The results, with reply latencies, are left on the server"""
+    timeout = 30
+    name = "Session"
+
+    def handle(self):
+        settings = self.server.settings
+        self.sending = threading.Lock()
+        self.pinged = threading.Event()
+        self.replies = Replies(window=getattr(settings, "window", None))
+
+        self.send(":localhost", "NOTICE", "*", self.name)
+        self.handshake()
+
+        reader = threading.Thread(target=self.read)
+        reader.daemon = True
+        reader.start()
+
+        started = time.time()
+        results = self.play(settings, started)
+        sending = time.time() - started
+
+        # Pings are answered in order, so this is when everything is handled
+        self.drain(settings.timeout)
+        handled = time.time() - started
+
+        # Give stragglers from slow commands a little longer
+        deadline = time.time() + settings.grace
+        while (time.time() < deadline) and self.replies.unanswered():
+            time.sleep(0.1)
+
+        sent = results["lines"]
+        results.update(self.replies.results())
+        results.update({
+            "settings": vars(settings),
+            "sending": sending,
+            "handled": handled,
+            "offered": sent / sending if sending else 0,
+            "throughput": sent / handled if handled else 0
+        })
+        self.server.results = results
+
+    def play(self, settings, started):
+        raise NotImplementedError
+
+    def heard(self, message):
+        ...
+
+    def handshake(self):
+        "Wait for the bot to register and join its channels"
+        while True:
+            message = self.recv()
+            if message is None:
+                raise EOFError("The bot disconnected during the handshake")
+            if message.get("command") == "WHO":
+                break
+
+    def read(self):
+        while True:
+            message = self.recv(timeout=None)
+            if message is None:
+                break
+
+            command = message.get("command")
+            if command == "PING":
+                self.send("PONG", message["parameters"][-1])
+            elif command == "PONG":
+                self.pinged.set()
+            else:
+                self.heard(message)
+
+    def drain(self, timeout):
+        self.pinged.clear()
+        self.send("PING", "drain")
+        if not self.pinged.wait(timeout):
+            raise Exception("The bot didn't catch up within %ss" % timeout)
+
+    def recv(self, timeout=30):
+        self.connection.settimeout(timeout)
+        try: octets = self.rfile.readline()
+        except socket.timeout:
+            return None
+        if not octets:
+            return None
+        return api.irc.parse_message(octets=octets)()
+
+    def write(self, octets):
+        with self.sending:
+            self.wfile.write(octets[:510] + b"\r\n")
+            self.wfile.flush()
+
+    def send(self, *args):
+        args = list(args)
+        if len(args) > 1:
+            args[-1] = ":" + args[-1]
+        self.write(" ".join(args).encode("utf-8", "replace"))
+
+class Listener(socketserver.TCPServer):
+    allow_reuse_address = True
+
+def serve(handler, settings):
+    "Serve one bot connection with a Session subclass, returning its results"
+    server = Listener(("localhost", settings.port), handler)
+    server.settings = settings
+    server.results = None
+    try: server.handle_request()
+    finally:
+        server.server_close()
+    return server.results
+
+def report(results, filename=None):
+    "Write results as JSON to a file, or to stdout"
+    results = json.dumps(results, indent=2, sort_keys=True)
+    if filename:
+        with open(filename, "w", encoding="utf-8") as f:
+            f.write(results + "\n")
+    else:
+        print(results)
+
+def client(filename):
+    # The bot is noisy, and the benchmark reports on stdout
+    null = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(null, sys.stdout.fileno())
+    os.dup2(null, sys.stderr.fileno())
+    duxlot.client(*duxlot.config.info(filename))
+
+class Server(object):
+    def __init__(self, options, target=client):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("localhost", 0))
+        self.listener.listen(1)
+        self.listener.settimeout(30)
+        port = self.listener.getsockname()[1]
+
+        self.directory = tempfile.mkdtemp(prefix="duxlot-bench-")
+        self.config = os.path.join(self.directory, "bench.json")
+        config = {
+            "address": "localhost:%s" % port,
+            "nick": "duxlot",
+            "start-channels": ["#duxlot"],
+            "admin-owner": "owner",
+            "flood": True
+        }
+        config.update(options)
+        with open(self.config, "w", encoding="utf-8") as f:
+            json.dump(config, f)
+
+        self.bot = multiprocessing.Process(target=target, args=(self.config,))
+        self.bot.start()
+
+        self.connection, address = self.listener.accept()
+        self.connection.settimeout(30)
+        self.rfile = self.connection.makefile("rb")
+
+    def send(self, *args):
+        args = list(args)
+        if len(args) > 1:
+            args[-1] = ":" + args[-1]
+        self.connection.sendall(" ".join(args).encode("utf-8") + b"\r\n")
+
+    def wait(self, command):
+        "Read lines until one has the given command"
+        while True:
+            octets = self.rfile.readline()
+            if not octets:
+                raise EOFError("The bot disconnected")
+            message = api.irc.parse_message(octets=octets)()
+            if message.get("command") == command:
+                return message
+
+    def handshake(self):
+        self.send(":localhost", "NOTICE", "*", "Benchmark")
+        self.wait("WHO")
+
+        # The PING handler also runs in the events stage, so it warms it up
+        self.send("PING", "warm")
+        self.wait("PONG")
+
+    def close(self):
+        try: self.connection.close()
+        except socket.error:
+            ...
+        self.listener.close()
+
+        def exited():
+            self.bot.terminate()
+            self.bot.join(10)
+            return not self.bot.is_alive()
+        stop(self.bot.pid, exited)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def run(count=1000, **options):
+    "Return mean wall and CPU seconds per message, for count messages"
+    lines = traffic()
+    server = Server(options)
+    try:
+        server.handshake()
+
+        octets = []
+        for i in range(count):
+            line = lines[i % len(lines)]
+            octets.append(":user!~user@localhost PRIVMSG #duxlot :" + line)
+        octets = ("\r\n".join(octets) + "\r\n").encode("utf-8")
+
+        # PING is answered only after every message before it is dispatched
+        start = time.time(), cpu(server.bot.pid)
+        server.connection.sendall(octets)
+        server.send("PING", "done")
+        server.wait("PONG")
+        wall = time.time() - start[0]
+        used = cpu(server.bot.pid) - start[1]
+        return wall / count, used / count
+    finally:
+        server.close()
+
+def consume(transport, results):
+    started = time.process_time()
+    count = 0
+    while True:
+        message = transport.get()
+        if message == "StopIteration":
+            break
+        # Stages read the command of every message
+        message["command"]
+        transport.task_done()
+        count += 1
+    results.put((count, time.time(), time.process_time() - started))
+
+def transport(kind, rate, seconds=2):
+    "Return the rate achieved, drain lag, and CPU seconds per message"
+    if kind == "ring":
+        transport = ring.Ring()
+    else:
+        transport = multiprocessing.JoinableQueue()
+    results = multiprocessing.Queue()
+    consumer = multiprocessing.Process(
+        target=consume,
+        args=(transport, results)
+    )
+    consumer.start()
+
+    octets = b":user!~user@localhost PRIVMSG #duxlot :see http://inamidst.com/"
+    count = int(rate * seconds)
+
+    start = time.time()
+    used = time.process_time()
+    for i in pace(count, rate, start):
+        transport.put(api.irc.Message(octets, i + 1))
+    sent = time.time()
+    used = time.process_time() - used
+    transport.put("StopIteration")
+
+    received, finished, consumed = results.get()
+    consumer.join()
+    if kind == "ring":
+        transport.close()
+
+    if received != count:
+        raise Exception("Sent %s messages, received %s" % (count, received))
+    achieved = count / (finished - start)
+    # Negative when the consumer caught up before the last interval was over
+    lag = max(0.0, finished - sent)
+    return achieved, lag, (used + consumed) / count
+
+def transports(rates=(1000, 10000, 100000)):
+    kinds = ("queue", "ring") if ring.available else ("queue",)
+    for rate in rates:
+        for kind in kinds:
+            achieved, lag, used = transport(kind, rate)
+            args = (kind, rate, round(achieved), round(lag * 1000, 1),
+                round(used * 1000000, 1))
+            msg = "transport=%s at %s/s: %s/s achieved, %sms lag, %sus CPU"
+            print(msg % args)
+
+# Arguments of api.text services that use the web, for benchmarking them
+# against recorded fixtures. The pages they fetch are recorded whole, so
+# parsing is timed just as it would be with live responses
+samples = [
+    ("wik", "Python (programming language)"),
+    ("g", "duxlot"),
+    ("title", "http://inamidst.com/duxlot/"),
+    ("head", "http://inamidst.com/duxlot/"),
+    ("metar", "EGLL"),
+    ("ety", "bot"),
+    ("rhymes", "time"),
+    ("w", "bot")
+]
+
+def services(record=False, count=10, directory=None):
+    """Mean seconds per call of web services served from fixtures, and
+    whether each still says what it said when the fixtures were recorded"""
+    if directory is None:
+        directory = os.path.join(duxlot.path, "test", "fixtures")
+    api.web.options.fixtures_directory = directory
+    # Otherwise the calls after the first would only time the cache
+    api.web.options.cache = False
+
+    filename = os.path.join(directory, "outputs.json")
+    expected = {}
+    if os.path.isfile(filename):
+        with open(filename, encoding="utf-8") as f:
+            expected = json.load(f)
+
+    results = {}
+    for name, text in samples:
+        service = getattr(api.text, name)
+        def call():
+            return service(text=text, maximum={"bytes": 360, "lines": 3})
+
+        try:
+            api.web.options.transport = "record" if record else "replay"
+            said = call()
+
+            api.web.options.transport = "replay"
+            started = time.time()
+            for i in range(count):
+                call()
+            seconds = (time.time() - started) / count
+        except Exception as err:
+            error = "%s: %s" % (err.__class__.__name__, err)
+            results[name] = {"error": error}
+            continue
+
+        if record:
+            expected[name] = said
+        results[name] = {"seconds": seconds, "same": said == expected.get(name)}
+
+    if record:
+        os.makedirs(directory, exist_ok=True)
+        with open(filename, "w", encoding="utf-8") as f:
+            json.dump(expected, f, indent=2, sort_keys=True)
+    return results
+
+### Microbenchmarks ###
+
+class Sink(object):
+    "A queue that drops everything put on it"
+
+    def put(self, item):
+        ...
+
+class Harness(object):
+    """Just enough of irc.Client for create_irc_env and event dispatch, with
+    options and the database in a manager, as in the bot"""
+
+    def __init__(self, directory):
+        self.manager = multiprocessing.Manager()
+        base = os.path.join(directory, "bench")
+        self.config = duxlot.FrozenStorage({
+            "name": base + ".json",
+            "base": base,
+            "data": {}
+        })
+        self.processes = {"send": duxlot.Storage({"queue": Sink()})}
+        self.private = duxlot.Storage({
+            "queue": {"schedule": Sink()},
+            "command": lambda *args: None
+        })
+        self.public = irc.Client.create_public(self)
+        self.standard_directory = os.path.join(duxlot.path, "standard")
+        irc.Client.populate_options(self)
+
+        # Inline events at every priority, so that dispatch itself is timed
+        def event(env):
+            ...
+        self.private.events = {
+            priority: {"*": [event], "PRIVMSG": [event]}
+            for priority in ("high", "medium", "low")
+        }
+
+    def close(self):
+        self.manager.shutdown()
+
+class Scheduler(object):
+    """process:schedule in a thread, on a frozen clock, with its queues here
+    so that events can be scheduled and its tasks taken"""
+
+    def __init__(self, directory, at=None):
+        self.harness = Harness(directory)
+        self.clock = duxlot.clock
+        self.events = queue.Queue()
+        self.tasks = queue.Queue()
+        private = duxlot.Storage({
+            "queue": {"schedule": self.events, "main": self.tasks}
+        })
+
+        self.clock.freeze(at)
+        slept = self.clock.slept.value
+        self.thread = threading.Thread(
+            target=irc.process_schedule,
+            args=(private, self.harness.public)
+        )
+        self.thread.daemon = True
+        self.thread.start()
+        self.settle(slept)
+
+    def settle(self, slept, timeout=60):
+        "Wait for the schedule to sleep again, having done everything due"
+        deadline = time.time() + timeout
+        while self.clock.slept.value == slept:
+            if time.time() > deadline:
+                raise Exception("The schedule didn't tick within %ss" % timeout)
+            time.sleep(self.clock.poll)
+
+    def schedule(self, unixtime, *task):
+        self.events.put((unixtime,) + task)
+
+    def advance(self, seconds):
+        "Move the clock on, and wait for the schedule to tick"
+        slept = self.clock.slept.value
+        self.clock.advance(seconds)
+        self.settle(slept)
+
+    def taken(self, name=None):
+        "Tasks put since the last call, or only those of this name"
+        tasks = []
+        while True:
+            try: task = self.tasks.get_nowait()
+            except queue.Empty:
+                break
+            if (name is None) or (task[0] == name):
+                tasks.append(task)
+        return tasks
+
+    def close(self):
+        self.events.put("StopIteration")
+        # A thawed clock wakes the schedule, to see the stop
+        self.clock.thaw()
+        self.thread.join(10)
+        self.harness.close()
+
+def scheduler(count=100000, days=3, step=600):
+    """Fast-forward the schedule through reminders spread over some days,
+    timing it, and checking that none is early, late, or out of order"""
+    directory = tempfile.mkdtemp(prefix="duxlot-bench-")
+    # Debugging output from periodic functions would swamp the results
+    level = duxlot.output.level.value
+    duxlot.output.configure(level="warning")
+    try:
+        schedule = Scheduler(directory)
+        try:
+            started = duxlot.clock.time()
+            # Seeded, so that every run schedules the same reminders
+            chosen = random.Random(count)
+            due = sorted(started + chosen.uniform(1, days * 86400)
+                for i in range(count))
+            order = list(range(count))
+            chosen.shuffle(order)
+
+            before = time.time()
+            for i in order:
+                schedule.schedule(due[i], "msg", "#duxlot", str(i))
+            # A tick short of the first reminder, as those already due when
+            # the schedule receives them are sent in the order received
+            schedule.advance(1)
+            scheduling = time.time() - before
+
+            before = time.time()
+            delivered = 0
+            early = 0
+            late = 0
+            previous = -1
+            disordered = 0
+            while delivered < count:
+                schedule.advance(step)
+                now = duxlot.clock.time()
+                for task in schedule.taken("msg"):
+                    i = int(task[2])
+                    if due[i] > now:
+                        early += 1
+                    elif due[i] <= (now - step):
+                        late += 1
+                    if i < previous:
+                        disordered += 1
+                    previous = i
+                    delivered += 1
+            running = time.time() - before
+            simulated = duxlot.clock.time() - started
+        finally:
+            schedule.close()
+    finally:
+        duxlot.output.level.value = level
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        "reminders": count,
+        "simulated": simulated,
+        "ticks": int(simulated / step),
+        "scheduling": scheduling,
+        "running": running,
+        "per_reminder": (scheduling + running) / count,
+        "early": early,
+        "late": late,
+        "disordered": disordered
+    }
+
+def measure(function, repeat=5):
+    "Fastest seconds per call over repeat runs of at least 0.2s each"
+    import timeit
+
+    timer = timeit.Timer(function)
+    number, taken = timer.autorange()
+    timings = sorted(taken / number
+        for taken in timer.repeat(repeat=repeat, number=number))
+    return {
+        "seconds": timings[0],
+        "median": timings[len(timings) // 2],
+        "number": number
+    }
+
+def suite(repeat=2, rounds=3):
+    """Time the operations on the per-message path, and some common services.
+    Each is measured once per round, so a burst of noise affects one only"""
+    import platform
+
+    directory = tempfile.mkdtemp(prefix="duxlot-bench-")
+    harness = Harness(directory)
+    public = harness.public
+    octets = b":user!~user@localhost PRIVMSG #duxlot :.seen someone"
+
+    # Plain arithmetic, to scale comparisons by the speed of the machine
+    def reference():
+        total = 0
+        for i in range(100):
+            total += i * i
+
+    def parse_message():
+        api.irc.Message(octets)["command"]
+
+    message = api.irc.Message(octets)
+    message["command"]
+    def create_irc_env():
+        irc.create_irc_env(public, message)
+
+    env = irc.create_irc_env(public, message)
+    def dispatch_events():
+        irc.dispatch_events(harness.private, public, message, env, 30)
+
+    storage = duxlot.Storage({"nick": "user", "sender": "#duxlot"})
+    def storage_attributes():
+        storage.nick
+        storage.text = "hello"
+        "sender" in storage
+
+    public.database.init("bench", {})
+    def database_context():
+        with public.database.context("bench") as bench:
+            bench["user"] = bench.get("user", 0) + 1
+
+    def options_lookup():
+        public.options("prefix", "channels")
+        public.options("nick")
+
+    api.unicode.cache_unicode_data()
+    def unicode_character():
+        api.unicode.by_character(characters="\u2603")
+
+    def unicode_name():
+        api.text.u(text="snowman", maximum={})
+
+    zonefile = "/usr/share/zoneinfo/Europe/London"
+    def zoneinfo_offset():
+        api.clock.zoneinfo_offset(filename=zonefile)
+
+    def periods_seconds():
+        api.clock.periods_seconds(text="3d 4h 5m")
+
+    benchmarks = [
+        ("parse_message", parse_message),
+        ("create_irc_env", create_irc_env),
+        ("dispatch_events", dispatch_events),
+        ("storage_attributes", storage_attributes),
+        ("database_context", database_context),
+        ("options_lookup", options_lookup),
+        ("unicode_character", unicode_character),
+        ("unicode_name", unicode_name),
+        ("periods_seconds", periods_seconds)
+    ]
+    if os.path.isfile(zonefile):
+        benchmarks.append(("zoneinfo_offset", zoneinfo_offset))
+
+    # Bound by IPC with the manager, or by the filesystem, so the speed of
+    # the reference says little about theirs
+    unscaled = {"create_irc_env", "database_context", "options_lookup",
+        "zoneinfo_offset"}
+
+    measured = {name: [] for name, function in benchmarks}
+    references = []
+    try:
+        for i in range(rounds):
+            for name, function in benchmarks:
+                # Measured between the others, so that its median is a steady
+                # speed for the whole suite, whatever a single run gets
+                references.append(measure(reference, repeat))
+                measured[name].append(measure(function, repeat))
+        references.append(measure(reference, repeat))
+    finally:
+        harness.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def median(values):
+        return sorted(values)[len(values) // 2]
+
+    results = {}
+    for name, timings in measured.items():
+        results[name] = {
+            "seconds": min(timing["seconds"] for timing in timings),
+            "median": median([timing["median"] for timing in timings]),
+            "number": timings[0]["number"],
+            "scaled": name not in unscaled
+        }
+
+    timings = [timing["seconds"] for timing in references]
+    results["reference"] = {
+        "seconds": median(timings),
+        "fastest": min(timings),
+        "slowest": max(timings),
+        "runs": len(timings)
+    }
+
+    return {
+        "duxlot": duxlot.version,
+        "python": platform.python_version(),
+        "benchmarks": results
+    }
+
+def compare(results, baseline, tolerance=0.25):
+    """Lines comparing results to a baseline, and the names of benchmarks
+    that are slower than it by more than the tolerance, a fraction. Changes
+    to CPU bound benchmarks are relative to the reference benchmark, as
+    machines vary in speed"""
+    def microseconds(seconds):
+        return "%.2fus" % (seconds * 1000000)
+
+    lines = []
+    slower = []
+    before = baseline.get("benchmarks", {})
+    after = results.get("benchmarks", {})
+
+    scale = 1.0
+    if ("reference" in before) and ("reference" in after):
+        scale = after["reference"]["seconds"] / before["reference"]["seconds"]
+        args = (microseconds(before["reference"]["seconds"]),
+            microseconds(after["reference"]["seconds"]))
+        msg = "reference: %s to %s, which scaled changes allow for"
+        lines.append(msg % args)
+
+    for name in sorted(set(before) | set(after)):
+        if name == "reference":
+            continue
+        if name not in before:
+            lines.append("%s: %s, new" % (name,
+                microseconds(after[name]["seconds"])))
+            continue
+        if name not in after:
+            lines.append("%s: missing" % name)
+            continue
+
+        old = before[name]["seconds"]
+        new = after[name]["seconds"]
+        # Baselines from before benchmarks were marked are all scaled
+        scaled = after[name].get("scaled", before[name].get("scaled", True))
+        adjusted = (new / scale) if scaled else new
+        change = (adjusted - old) / old if old else 0.0
+        status = "ok"
+        if change > tolerance:
+            status = "SLOWER"
+            slower.append(name)
+        args = (name, microseconds(old), microseconds(new),
+            round(change * 100), status)
+        lines.append("%s: %s to %s, %+i%%, %s" % args)
+    return lines, slower
+
+def main(count=1000):
+    for pipeline in ("split", "merged"):
+        wall, used = run(count, pipeline=pipeline)
+        args = (pipeline, count, round(wall * 1000000), round(used * 1000000))
+        msg = "pipeline=%s: %s messages, %sus wall and %sus CPU per message"
+        print(msg % args)
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["transports"]:
+        transports()
+    elif sys.argv[1:] == ["scheduler"]:
+        print(json.dumps(scheduler(), indent=2, sort_keys=True))
+    elif sys.argv[1:2] == ["services"]:
+        # With "record" as well, the fixtures are recorded from the web first
+        results = services(record=(sys.argv[2:] == ["record"]))
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        main()
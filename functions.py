@@ -38,7 +38,14 @@ def event(name, concurrent=False):
         return function
     return decorate
 
-# decorators = (command, named, event)
+def deadline(seconds):
+    "Decorate a function to limit the time it may spend on network calls"
+    def decorate(function):
+        function.deadline = seconds
+        return function
+    return decorate
+
+# decorators = (command, named, event, deadline)
 
 startups = []
 
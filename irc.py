@@ -8,6 +8,7 @@
 
 import os.path
 import multiprocessing
+import resource
 import signal
 import socket
 import sys
@@ -18,12 +19,20 @@ import duxlot
 # Save PEP 3122!
 if "." in __name__:
     from . import api
+    from . import metrics
     from . import options
     from . import process
+    from . import profiling
+    from . import ring
+    from . import traffic
 else:
     import api
+    import metrics
     import options
     import process
+    import profiling
+    import ring
+    import traffic
 
 # @@ Could move this to storage.filesystem.modules(directory)
 def modules_in_directory(directory):
@@ -36,6 +45,9 @@ def modules_in_directory(directory):
 
 debug = duxlot.output.write
 
+# Seconds a command may run past its deadline before it is killed
+grace = 15
+
 def task(method):
     name = method.__name__.rsplit("_", 1).pop()
     task.methods[name] = method
@@ -52,13 +64,27 @@ class Client(object):
             "data": data
         })
 
+        self.started = time.time()
+        self.restarts = 0
+        self.reloads = 0
+        self.endpoint = None
+        self.monitor = metrics.Monitor()
+
         self.manager = multiprocessing.Manager()
+        # Every process now logs through this process, without blocking
+        duxlot.output.start()
+        # Latency histograms from every process are merged into this
+        metrics.recorder.store = self.manager.dict()
+        profiling.profiler.directory = duxlot.config.path(base + ".profiles")
+        profiling.watchdog.filename = duxlot.config.path(base + ".slow")
+        traffic.recording.filename = duxlot.config.path(base + ".traffic")
         self.lock = multiprocessing.RLock()
         self.processes = process.Processes(self.create_socket)
         self.commands = process.Commands(self.manager)
 
         self.private = self.create_private()
         self.public = self.create_public()
+        self.commands.statistics = self.public.data
 
         self.standard_directory = os.path.join(duxlot.path, "standard")
         self.populate_options()
@@ -81,6 +107,13 @@ class Client(object):
         private = duxlot.Storage()
 
         private.command = self.commands.spawn
+        private.commands = self.commands
+        # Bumped whenever process:receive should rebuild its filter
+        private.filter = multiprocessing.Value("i", 0, lock=False)
+        # Each is only written by the process named, for the metrics endpoint
+        private.received = multiprocessing.Value("q", 0, lock=False)
+        private.filtered = multiprocessing.Value("q", 0, lock=False)
+        private.sent = multiprocessing.Value("q", 0, lock=False)
         # private.events is set later on
         # private.named is set later on
         private.queue = {
@@ -104,6 +137,8 @@ class Client(object):
             self.manager.Namespace()
         )
         public.debug = debug
+        public.latency = metrics.recorder
+        public.profiler = profiling.profiler
         public.options = options.Options(
             self.config.name,
             self.manager,
@@ -128,7 +163,9 @@ class Client(object):
                 args[-1] = ":" + args[-1]
     
             octets = " ".join(args).encode("utf-8", "replace")
-            self.processes["send"].queue.put(octets)
+            # Stamped so that process:send can time the queue, and the reply
+            origin = metrics.recorder.origin
+            self.processes["send"].queue.put((octets, time.time(), origin))
         public.send = send
 
         def msg(*args):
@@ -214,9 +251,233 @@ class Client(object):
                 for prefix in value.values():
                     check(prefix)
                 return {"channels": value}
+
+        @group()
+        class ignore(option):
+            "Hostmasks, like nick!user@host with * wildcards, to ignore"
+            default = []
+            types = {list}
+
+            def parse(self, value):
+                for mask in value:
+                    if not isinstance(mask, str):
+                        raise ValueError("Hostmasks must be strings")
+
+            def react(self):
+                self.public.task("filter")
+
+        @group()
+        class transport(option):
+            "How messages pass between processes: queue, or ring (faster)"
+            default = "queue"
+
+            def parse(self, value):
+                if value not in {"queue", "ring"}:
+                    raise ValueError("Expected queue or ring")
+
+            def react(self):
+                self.public.task("restart")
+
+        @group()
+        class pipeline(option):
+            "Whether events run in their own process (split) or not (merged)"
+            default = "split"
+
+            def parse(self, value):
+                if value not in {"split", "merged"}:
+                    raise ValueError("Expected split or merged")
+
+            def react(self):
+                self.public.task("reload")
         
         self.public.options.complete()
 
+        @group("metrics")
+        class address(option):
+            "Serve metrics here, as host:port or a socket path, or not if empty"
+            default = ""
+
+            def parse(self, value):
+                if value and ("/" not in value):
+                    if not self.regexp(r"[^:]*:[0-9]+", value):
+                        raise ValueError("Expected host:port, or a path")
+
+            def react(self):
+                self.public.task("endpoint")
+
+        self.public.options.complete("metrics")
+
+        @group("profile")
+        class commands(option):
+            "Fraction of command runs to profile, from 0 (none) to 1 (all)"
+            default = 0
+            types = {int, float}
+
+            def parse(self, value):
+                if not (0 <= value <= 1):
+                    raise ValueError("Expected a fraction from 0 to 1")
+
+            def react(self):
+                profiling.profiler.configure(fraction=self.data.value)
+
+        @group("profile")
+        class process(option):
+            "Pipeline process to profile: receive, send, messages, or events"
+            default = ""
+
+            def parse(self, value):
+                if value and (value not in profiling.Profiler.processes):
+                    raise ValueError("Unknown pipeline process: %s" % value)
+
+            def react(self):
+                profiling.profiler.configure(process=self.data.value)
+
+        self.public.options.complete("profile")
+
+        @group("record")
+        class traffic_(option):
+            "Whether to record received lines, for replaying with test/replay.py"
+            default = False
+            types = {bool}
+
+            def react(self):
+                traffic.recording.configure(enabled=self.data.value)
+
+        @group("record")
+        class web(option):
+            "Record web responses as fixtures (record), or serve them (replay)"
+            default = ""
+
+            def parse(self, value):
+                if value not in {"", "record", "replay"}:
+                    raise ValueError("Expected record, replay, or nothing")
+
+            def react(self):
+                self.public.task("reload")
+
+        @group("record")
+        class latency(option):
+            "Seconds to wait before serving each replayed web response"
+            default = 0
+            types = {int, float}
+
+            def parse(self, value):
+                if value < 0:
+                    raise ValueError("Expected a number of seconds, 0 or more")
+
+            def react(self):
+                self.public.task("reload")
+
+        self.public.options.complete("record")
+
+        @group("monitor")
+        class cpu(option):
+            "CPU percentage of a process to alert the owner at, or 0 for never"
+            default = 90
+            types = {int, float}
+
+        @group("monitor")
+        class rss(option):
+            "Megabytes of RSS of a process to alert the owner at"
+            default = 512
+            types = {int, float}
+
+        @group("monitor")
+        class fds(option):
+            "Number of open files of a process to alert the owner at"
+            default = 512
+            types = {int}
+
+        @group("monitor")
+        class depth(option):
+            "Number of messages queued for a process to alert the owner at"
+            default = 1000
+            types = {int}
+
+        @group("monitor")
+        class growth(option):
+            "Percentage RSS growth over ten minutes to alert the owner at"
+            default = 50
+            types = {int, float}
+
+        self.public.options.complete("monitor")
+
+        @group("command")
+        class deadline(option):
+            "Default number of seconds a command may spend on network calls"
+            default = 30
+            types = {int, float}
+
+        @group("command")
+        class slow(option):
+            "Seconds after which a command's stack is logged, or 0 for never"
+            default = 10
+            types = {int, float}
+
+            def react(self):
+                profiling.watchdog.configure(threshold=self.data.value)
+
+        @group("command")
+        class processes(option):
+            "Maximum number of commands running at once"
+            default = 18
+            types = {int}
+
+        @group("command")
+        class user(option):
+            "Maximum number of commands one nick may run, and have queued"
+            default = 3
+            types = {int}
+
+        @group("command")
+        class queue(option):
+            "Maximum number of commands waiting to run"
+            default = 36
+            types = {int}
+
+        self.public.options.complete("command")
+
+        @group("log")
+        class level(option):
+            "Least severe level to log: debug, info, warning, or error"
+            default = "debug"
+
+            def parse(self, value):
+                if value not in duxlot.output.levels:
+                    raise ValueError("Unknown log level: %s" % value)
+
+            def react(self):
+                duxlot.output.configure(level=self.data.value)
+
+        @group("log")
+        class sample(option):
+            "Log only one in this many RECV and SENT lines"
+            default = 1
+            types = {int}
+
+            def react(self):
+                duxlot.output.configure(sample=self.data.value)
+
+        @group("log")
+        class maximum(option):
+            "Bytes at which to rotate the -o output file, or 0 not to"
+            default = 0
+            types = {int}
+
+            def react(self):
+                duxlot.output.configure(maximum=self.data.value)
+
+        @group("log")
+        class backups(option):
+            "Number of rotated output files to keep"
+            default = 3
+            types = {int}
+
+            def react(self):
+                duxlot.output.configure(backups=self.data.value)
+
+        self.public.options.complete("log")
+
     def handle_signals(self):
         # http://stackoverflow.com/questions/2549939
         signames = {}
@@ -244,6 +505,7 @@ class Client(object):
 
             # Send SIGKILL to any remaining processes that we know of
             process.killall()
+            self.close_transports()
 
             # Since we're exiting, we don't need to mop up process queues
             os._exit(0)
@@ -254,6 +516,7 @@ class Client(object):
             try: self.processes[self.processes.socket].finish()
             except: ...
             process.killall()
+            self.close_transports()
             sys.exit() # Not os._exit
         signal.signal(signal.SIGUSR1, broken_script_pipe)
 
@@ -355,6 +618,25 @@ class Client(object):
         self.private.events = duxlot.events.copy()
 
         self.public.options.load(react=react)
+        self.main_filter()
+        self.main_endpoint()
+
+        duxlot.output.configure(
+            level=self.public.options("log-level"),
+            sample=self.public.options("log-sample"),
+            maximum=self.public.options("log-maximum"),
+            backups=self.public.options("log-backups")
+        )
+        profiling.profiler.configure(
+            fraction=self.public.options("profile-commands"),
+            process=self.public.options("profile-process")
+        )
+        profiling.watchdog.configure(
+            threshold=self.public.options("command-slow")
+        )
+        traffic.recording.configure(
+            enabled=self.public.options("record-traffic")
+        )
 
     def start(self):
         functions = {
@@ -367,8 +649,49 @@ class Client(object):
 
         for name, function in functions.items():
             self.processes[name].action(function, self.private, self.public)
+        self.transports()
         self.processes.start()
 
+    def transports(self):
+        # Only call this when all processes are stopped
+        # Rings need a single producer, so only these two queues can use them
+        use_rings = self.public.options("transport") == "ring"
+        if use_rings and (not ring.available):
+            debug("Warning: The ring transport needs Python 3.8 or later, "
+                "and x86")
+            use_rings = False
+
+        for name in ("messages", "events"):
+            current = self.processes[name].queue
+            if use_rings == isinstance(current, ring.Ring):
+                continue
+
+            if use_rings:
+                replacement = ring.Ring()
+            else:
+                current.close()
+                replacement = multiprocessing.JoinableQueue()
+            self.processes[name].queue = replacement
+            self.private.queue[name] = replacement
+
+    def close_transports(self):
+        # Only call this when exiting, after the processes have stopped
+        # Shared memory outlives the bot unless it's unlinked
+        for name in ("messages", "events"):
+            current = self.processes[name].queue
+            if isinstance(current, ring.Ring):
+                current.close()
+
+    def depths(self):
+        "Map each queue name to its number of waiting items, where known"
+        depths = {}
+        for name, queue in self.private.queue.items():
+            # Not implemented on some platforms, such as OS X
+            try: depths[name] = queue.qsize()
+            except NotImplementedError:
+                ...
+        return depths
+
     def create_socket(self):
         sock = socket.socket(socket.AF_INET, socket.TCP_NODELAY)
 
@@ -426,6 +749,7 @@ class Client(object):
 
         with self.lock:
             debug("Reloading...")
+            self.reloads += 1
             success = self.reload(sender, nick)
             if success:
                 self.setup(react=True)
@@ -454,6 +778,7 @@ class Client(object):
     @task
     def main_restart(self):
         # @@ Send QUIT
+        self.restarts += 1
         self.processes.stop()
         debug("Stopped processes...")
         debug(" ")
@@ -475,6 +800,7 @@ class Client(object):
                 self.processes.empty()
 
         debug("Starting processes...")
+        self.transports()
         self.processes.start()
 
     # @@
@@ -509,6 +835,7 @@ class Client(object):
             self.public.send("QUIT")
 
         self.processes.stop()
+        self.close_transports()
         sys.exit(0)
 
     @task
@@ -535,40 +862,173 @@ class Client(object):
             self.public.msg(sender, nick + ": " + text)
 
     @task
-    def main_collect(self, timeout=60):
-        collectable = self.commands.collectable(timeout)
-
-        if collectable:
-            debug("Pausing processes")
-            # @@ Finish sending, join the sending queue
-            self.private.queue["send"].join()
-            self.processes.empty()
-            self.processes.pause()
-
-            debug("Collecting commands")
-            collected = self.commands.collect(max(0, timeout - 10))
-            debug("Collected", collected, "commands")
-
-            debug("Flushing queues")
-            # self.processes.flush()
-
-            # @@ But we don't reset them!
-            # debug("Setting new queues")
-            # self.processes["send"].queue = multiprocessing.JoinableQueue()
-            # self.processes["schedule"].queue = multiprocessing.JoinableQueue()
-            # self.p... oh
-
-            debug("Setting new actions")
-            self.processes["send"].action(
-                process_send, self.private, self.public
-            )
-            self.processes["schedule"].action(
-                process_schedule, self.private, self.public
-            )
+    def main_monitor(self):
+        if not self.monitor.available:
+            return
+
+        pids = {"main": os.getpid(), "manager": self.manager._process.pid}
+        for name in (self.processes.socket,) + self.processes.queues:
+            process = self.processes[name].process
+            if (process is not None) and (process.pid is not None):
+                pids[name] = process.pid
+        pids.update(self.commands.pid.items())
+
+        depths = self.depths()
+        # Only pipeline processes are known by the names of their queues
+        depths = {name: depths[name] for name in self.processes.queues
+            if name in depths}
+        self.monitor.sample(pids, depths)
+
+        limits = {}
+        for kind in ("cpu", "rss", "fds", "depth", "growth"):
+            limits[kind] = self.public.options("monitor-" + kind)
+        for alert in self.monitor.alerts(limits):
+            debug("Alert:", alert, level="warning")
+            self.public.msg(self.public.options("admin-owner"), alert)
+
+    @task
+    def main_top(self, sender, nick):
+        if not self.monitor.available:
+            return self.public.msg(sender, nick + ": Only works on Linux")
+
+        def megabytes(octets):
+            return "%sMB" % round(octets / 1048576, 1)
+
+        results = []
+        commands = [0, 0.0, 0]
+        for name, history in self.monitor.history.items():
+            when, cpu, rss, fds, depth = history[-1]
+            if name.startswith("Command "):
+                commands[0] += 1
+                commands[1] += cpu
+                commands[2] += rss
+                continue
+
+            text = "%s %s%% %s" % (name, round(cpu, 1), megabytes(rss))
+            growth = self.monitor.growth(name)
+            if growth:
+                sign = "+" if (growth > 0) else "-"
+                text += "(%s%s)" % (sign, megabytes(abs(growth)))
+            text += " %sfd" % fds
+            if name in self.processes.queues:
+                text += " q%s" % depth
+            results.append(text)
+
+        if commands[0]:
+            args = (commands[0], round(commands[1], 1), megabytes(commands[2]))
+            results.append("%s commands %s%% %s" % args)
+
+        if results:
+            self.public.msg(sender, nick + ": " + ", ".join(results))
+        else:
+            self.public.msg(sender, nick + ": Nothing has been sampled yet")
+
+    @task
+    def main_filter(self):
+        # Commands are matched in process:messages, so PRIVMSG always passes
+        # The first line always passes, so "1st" events need nothing here
+        commands = {"PRIVMSG"}
+        for priority in self.private.events.values():
+            commands.update(priority.keys())
+        commands.discard("1st")
+
+        self.public.data["receive-filter"] = {
+            "commands": sorted(commands),
+            "ignore": self.public.options("ignore")
+        }
+        self.private.filter.value += 1
+
+    @task
+    def main_collect(self):
+        # Supervisors kill commands at their deadlines, so this only has to
+        # catch commands orphaned when their spawning process was restarted
+        collected = self.commands.collect()
+        if collected:
+            debug("Collected", collected, "orphaned commands")
 
-            debug("Resuming...")
-            self.processes.resume()
-            debug("Resumed")
+    @task
+    def main_endpoint(self):
+        address = self.public.options("metrics-address")
+        if self.endpoint is not None:
+            if self.endpoint.address == address:
+                return
+            self.endpoint.close()
+            self.endpoint = None
+
+        if address:
+            try: self.endpoint = metrics.Endpoint(address, self.measurements)
+            except (OSError, ValueError) as err:
+                debug("Couldn't serve metrics on", address + ":", err)
+            else:
+                debug("Serving metrics on", address)
+
+    def measurements(self):
+        "Metric families for the endpoint, which calls this in a thread"
+        def counter(name, description, value):
+            return (name, "counter", description, [("", None, value)])
+
+        def gauge(name, description, value):
+            return (name, "gauge", description, [("", None, value)])
+
+        data = self.public.data
+        families = [
+            gauge("duxlot_start_time_seconds",
+                "When the bot was started", self.started),
+            counter("duxlot_messages_received_total",
+                "Lines received from the server", self.private.received.value),
+            counter("duxlot_messages_filtered_total",
+                "Lines dropped before parsing", self.private.filtered.value),
+            counter("duxlot_messages_sent_total",
+                "Lines sent to the server", self.private.sent.value),
+            counter("duxlot_restarts_total",
+                "Restarts, each of which reconnects", self.restarts),
+            counter("duxlot_reloads_total",
+                "Reloads of the modules", self.reloads),
+            gauge("duxlot_commands_active",
+                "Command processes running", self.commands.active.value),
+            counter("duxlot_commands_admitted_total",
+                "Commands admitted to run", data.get("admission-admitted", 0)),
+            counter("duxlot_commands_rejected_total",
+                "Commands rejected by admission control",
+                data.get("admission-rejected", 0)),
+            counter("duxlot_database_dumps_total",
+                "Writes of database files", self.public.database.dumps.value),
+            counter("duxlot_log_dropped_total",
+                "Log lines dropped because the writer was behind",
+                duxlot.output.dropped.value)
+        ]
+
+        depths = [("", {"queue": name}, depth)
+            for name, depth in sorted(self.depths().items())]
+        families.append(("duxlot_queue_depth", "gauge",
+            "Messages waiting in each process queue", depths))
+
+        samples = []
+        for name in ("hits", "misses", "revalidated", "negative"):
+            value = data.get("web-cache-" + name, 0)
+            samples.append(("", {"result": name}, value))
+        families.append(("duxlot_web_cache_total", "counter",
+            "Web cache lookups, by result", samples))
+
+        stages = {}
+        commands = {}
+        for name, histogram in metrics.recorder.histograms().items():
+            if name.startswith("command:"):
+                commands[name.split(":", 1)[1]] = histogram
+            else:
+                stages[name] = histogram
+        families.append(metrics.summaries("duxlot_stage_latency_seconds",
+            "Latency of each stage of the message pipeline", "stage", stages))
+        families.append(metrics.summaries("duxlot_command_seconds",
+            "Execution time of each command", "command", commands))
+        return families
+
+    @task
+    def main_latency(self):
+        filename = duxlot.config.path(self.config.base + ".latency")
+        try: metrics.recorder.dump(filename)
+        except (IOError, OSError) as err:
+            debug("Couldn't dump latency histograms:", err)
 
     @task
     def main_ping(self):
@@ -586,6 +1046,34 @@ class Client(object):
 
 ### Processes ###
 
+def receive_filter(spec):
+    "Create a function saying whether a raw line is wanted"
+    import fnmatch
+    import re
+
+    commands = {command.encode("ascii") for command in spec["commands"]}
+    everything = b"*" in commands
+
+    ignore = None
+    if spec["ignore"]:
+        masks = [fnmatch.translate(mask) for mask in spec["ignore"]]
+        pattern = "|".join(masks).encode("utf-8")
+        ignore = re.compile(pattern, re.IGNORECASE)
+
+    def wanted(octets):
+        if octets.startswith(b":"):
+            prefix, _, rest = octets[1:].partition(b" ")
+            if ignore and (b"!" in prefix) and ignore.match(prefix):
+                return False
+        else:
+            rest = octets
+
+        if everything:
+            return True
+        command = rest.lstrip(b" ").split(b" ", 1)[0].rstrip(b"\r\n")
+        return command.upper() in commands
+    return wanted
+
 # (a) process:receive
 def process_receive(private, public):
     debug("START! process_receive")
@@ -593,24 +1081,43 @@ def process_receive(private, public):
 
     def receive_loop(sockfile, private):
         count = 0
+        version = None
         for octets in sockfile:
-            o = api.irc.parse_message(octets=octets)
             count += 1
-            o.count = count
-            private.queue["messages"].put(o())
+            private.received.value += 1
+            profiling.profiler.check("receive")
+            if private.filter.value != version:
+                version = private.filter.value
+                wanted = receive_filter(public.data["receive-filter"])
+
+            stamp = time.time()
+            traffic.recording.write(stamp, octets)
+
+            # Dropped before parsing, or being sent to any other process
+            if (count > 1) and (not wanted(octets)):
+                private.filtered.value += 1
+                continue
+
+            # Parsed lazily by whichever process reads it
+            message = api.irc.Message(octets, count, stamp)
+            private.queue["messages"].put(message)
 
             # @@ debug here can hang if there are pipe problems
-            debug("RECV:", octets)
+            debug("RECV:", octets, sample="RECV")
 
     with private.socket.makefile("rb") as sockfile:
         try: receive_loop(sockfile, private)
         except (IOError, EOFError, socket.error, ssl.SSLError):
             # @@ debug here can hang if there are pipe problems
             debug("Got socket or SSL error")
+            profiling.profiler.finish("receive")
+            traffic.recording.close()
             public.task("restart")
         else:
             # @@ debug here can hang if there are pipe problems
             debug("Got regular disco")
+            profiling.profiler.finish("receive")
+            traffic.recording.close()
             public.task("restart") # @@
 
     # @@ debug here can hang if there are pipe problems
@@ -630,9 +1137,11 @@ def process_send(private, public):
         
         with private.socket.makefile("wb") as sockfile:
             while True:
-                octets = send_get()
-                if octets == "StopIteration":
+                item = send_get()
+                if item == "StopIteration":
                     break
+                profiling.profiler.check("send")
+                octets, enqueued, origin = item
     
                 octets = octets.replace(b"\r", b"")
                 octets = octets.replace(b"\n", b"")
@@ -652,14 +1161,21 @@ def process_send(private, public):
                 sockfile.write(octets + b"\r\n")
                 sockfile.flush()
 
+                private.sent.value += 1
+                written = time.time()
+                metrics.record("send", written - enqueued)
+                if origin is not None:
+                    metrics.record("reply", written - origin)
+
                 # @@ debug here can hang if there are pipe problems
-                debug("SENT:", octets + b"\r\n")
+                debug("SENT:", octets + b"\r\n", sample="SENT")
                 send_done()
 
     try: send_loop()
     except (IOError, EOFError, socket.error, ssl.SSLError) as err:
         debug("Send Error:", err.__class__.__name__, err)
 
+    profiling.profiler.finish("send")
     send_done()
     # @@ debug here can hang if there are pipe problems
     debug("DONE! process:send")
@@ -668,7 +1184,22 @@ def process_send(private, public):
 def process_messages(private, public):
     debug("START! process_messages")
     public.database.cache.usage = public.database.load("usage") or {}
+    public.database.cache.costs = public.database.load("costs") or {}
+    deadline = public.options("command-deadline")
+    private.commands.admit(
+        public.options("command-processes"),
+        public.options("command-user"),
+        public.options("command-queue")
+    )
+    # When merged, events are dispatched here and process:events is idle
+    merged = public.options("pipeline") == "merged"
+    # Inherited by the commands spawned from here
+    api.web.options.transport = public.options("record-web") or "live"
+    api.web.options.fixtures_latency = public.options("record-latency")
     messages_get = private.queue["messages"].get
+    # When each nick was last told that the bot is busy, so that a flood of
+    # rejected commands doesn't get a flood of replies
+    told = {}
     while True:
         # debug("Waiting for message")
         message = messages_get()
@@ -676,15 +1207,40 @@ def process_messages(private, public):
         # debug("Got message", message)
         if message == "StopIteration":
             break
+        profiling.profiler.check("messages")
+
+        metrics.recorder.origin = message.stamp
+        metrics.record("queue", stamp - message.stamp)
+        # Reading the command parses the message
+        event = message["command"]
+        parsed = time.time()
+        metrics.record("parse", parsed - stamp)
 
-        if message["command"] == "PRIVMSG":
+        env = None
+        if event == "PRIVMSG":
             env = create_irc_env(public, message)
 
             if "command" in env:
                 if env.command in private.named:
-                    def process_command(env):
+                    function = private.named[env.command]
+                    seconds = getattr(function, "deadline", deadline)
+
+                    # Bound now, as admission may start this much later
+                    def process_command(env, function=function,
+                            seconds=seconds, parsed=parsed):
+                        started = time.time()
+                        before = resource.getrusage(resource.RUSAGE_SELF)
+                        fetched = duxlot.budget.fetched
+                        duxlot.budget.expires = duxlot.clock.time() + seconds
+                        metrics.recorder.origin = env.message.stamp
+                        metrics.record("spawn", started - parsed)
+
                         # @@ pre-command
-                        try: private.named[env.command](env)
+                        killed = started + seconds + grace
+                        watched = profiling.watchdog.watch(env, killed)
+                        # Usually None, as profiling is off by default
+                        profile = profiling.profiler.sample()
+                        try: function(env)
                         except api.Error as err:
                             env.say("Error: %s" % err)
                         except Exception as err:
@@ -708,50 +1264,120 @@ def process_messages(private, public):
                                 debug(line)
                             debug("---")
                         # @@ post-command
+                        if watched is not None:
+                            watched.set()
+                        if profile is not None:
+                            profiling.profiler.sampled(env.command, profile)
+
+                        name = "command:" + env.command
+                        metrics.record(name, time.time() - started)
+
+                        after = resource.getrusage(resource.RUSAGE_SELF)
+                        cost = {
+                            "wall": time.time() - started,
+                            "cpu": (after.ru_utime + after.ru_stime) -
+                                (before.ru_utime + before.ru_stime),
+                            # Kilobytes, except on OS X
+                            "rss": after.ru_maxrss * (
+                                1 if (sys.platform == "darwin") else 1024),
+                            "network": duxlot.budget.fetched - fetched
+                        }
         
                         with public.database.context("usage") as usage:
                             usage.setdefault(env.command, 0)
                             usage[env.command] += 1
-        
-                    private.command(process_command, env)
 
-        private.queue["events"].put(message)
+                        with public.database.context("costs") as costs:
+                            metrics.account(costs, env.command, cost)
+        
+                    # Killed by the supervisor if it overruns its budget
+                    key = (env.sender, env.nick)
+                    if not private.command(
+                            process_command, env, seconds + grace, key):
+                        if (parsed - told.get(env.nick, 0)) >= 30:
+                            told = {nick: when for nick, when in told.items()
+                                if (parsed - when) < 30}
+                            told[env.nick] = parsed
+                            env.reply("Busy, try again in a moment")
+
+        # Commands are always spawned before events run, in either pipeline
+        if merged:
+            if env is None:
+                env = create_irc_env(public, message)
+            dispatched = time.time()
+            dispatch_events(private, public, message, env, deadline)
+            metrics.record("events", time.time() - dispatched)
+        else:
+            private.queue["events"].put(message)
         private.queue["messages"].task_done()
 
     private.queue["messages"].task_done()
+    profiling.profiler.finish("messages")
+    private.commands.stop()
     # @@ debug here can hang if there are pipe problems
     debug("DONE! process:messages")
 
+def dispatch_events(private, public, message, env, deadline):
+    commands = ["*", message["command"]]
+    if message["count"] == 1:
+        commands = ["1st"] + commands
+
+    for priority in ["high", "medium", "low"]:
+        for command in commands:
+            for function in private.events[priority].get(command, []):
+                # Bound now, as admission may start this much later
+                def process_command(env, function=function):
+                    seconds = getattr(function, "deadline", deadline)
+                    duxlot.budget.expires = duxlot.clock.time() + seconds
+                    metrics.recorder.origin = env.message.stamp
+
+                    try: function(env)
+                    except Exception as err:
+                        debug("Error:", str(err))
+                    finally:
+                        # Inline events mustn't leave a budget behind
+                        duxlot.budget.expires = None
+
+                if not hasattr(function, "concurrent"):
+                    process_command(env)
+                elif function.concurrent:
+                    seconds = getattr(function, "deadline", deadline)
+                    key = None
+                    if ("sender" in env) and ("nick" in env):
+                        key = (env.sender, env.nick)
+                    private.command(
+                        process_command, env, seconds + grace, key
+                    )
+                else:
+                    process_command(env)
+
 # (d) process:events
 def process_events(private, public):
     debug("START! process_events")
+    deadline = public.options("command-deadline")
+    api.web.options.transport = public.options("record-web") or "live"
+    api.web.options.fixtures_latency = public.options("record-latency")
+    private.commands.admit(
+        public.options("command-processes"),
+        public.options("command-user"),
+        public.options("command-queue")
+    )
     while True:
         message = private.queue["events"].get()
         if message == "StopIteration":
             break
+        profiling.profiler.check("events")
 
-        commands = ["*", message["command"]]
-        if message["count"] == 1:
-            commands = ["1st"] + commands
-
+        metrics.recorder.origin = message.stamp
+        dispatched = time.time()
         env = create_irc_env(public, message)
-        for priority in ["high", "medium", "low"]:
-            for command in commands:
-                for function in private.events[priority].get(command, []):
-                    def process_command(env):
-                        try: function(env)
-                        except Exception as err:
-                            debug("Error:", str(err))
-
-                    if not hasattr(function, "concurrent"):
-                        process_command(env)
-                    elif function.concurrent:
-                        private.command(process_command, env)
-                    else:
-                        process_command(env)
+        dispatch_events(private, public, message, env, deadline)
+        metrics.record("events", time.time() - dispatched)
 
         private.queue["events"].task_done()
     private.queue["events"].task_done()
+    profiling.profiler.finish("events")
+    private.commands.stop()
     # @@ debug here can hang if there are pipe problems
     debug("DONE! process:events")
 
@@ -761,8 +1387,8 @@ def process_schedule(private, public):
 
     import heapq
     import queue
-    import time
 
+    clock = duxlot.clock
     database = public.database
     # @@ the set queue is not reliable!
     receive = private.queue["schedule"].get
@@ -781,7 +1407,7 @@ def process_schedule(private, public):
             periodic.functions[name] = function
             periodic.period[name] = period
             periodic.called[name] = 0
-            periodic.stamp[name] = time.time()
+            periodic.stamp[name] = clock.time()
 
             return function
         return decorate
@@ -813,18 +1439,26 @@ def process_schedule(private, public):
         # @@ dump only if it's changed
         database.dump("schedule", schedule)
 
-    @periodic(30)
+    @periodic(120)
     def collect(current):
-        # @@ this means processes can run for about 90 seconds
         task(("collect",))
 
+    @periodic(300)
+    def latency(current):
+        task(("latency",))
+
+    # Ten minutes of history are kept, at this period
+    @periodic(10)
+    def monitor(current):
+        task(("monitor",))
+
     def tick():
         nonlocal receive
         nonlocal schedule
 
         def elapsed():
-            return time.time() - elapsed.start
-        elapsed.start = time.time()
+            return clock.time() - elapsed.start
+        elapsed.start = clock.time()
 
         # Spend 2/3 the duration handling the queue
         while True:
@@ -832,7 +1466,7 @@ def process_schedule(private, public):
             if remaining <= 0:
                 break
 
-            try: event = receive(timeout=remaining)
+            try: event = receive(timeout=clock.timeout(remaining))
             except queue.Empty:
                 break
             else:
@@ -855,7 +1489,7 @@ def process_schedule(private, public):
                     heapq.heappush(schedule, event)
 
         # Handle the schedule
-        current = time.time()
+        current = clock.time()
 
         while True:
             if not schedule:
@@ -871,7 +1505,7 @@ def process_schedule(private, public):
             task(tuple(event[1:]))
 
         # Handle periodic functions
-        current = time.time()
+        current = clock.time()
 
         for name in periodic.functions:
             period = periodic.period[name]
@@ -883,12 +1517,12 @@ def process_schedule(private, public):
                 debug("PERIODIC:", name)
                 periodic.functions[name](current)
                 periodic.called[name] += 1
-                periodic.stamp[name] = time.time()
+                periodic.stamp[name] = clock.time()
 
         # Sleep for the rest of the duration
         remaining = duration - elapsed()
         if remaining > 0:
-            time.sleep(remaining)
+            clock.sleep(remaining)
 
         return True
 
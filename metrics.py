@@ -0,0 +1,352 @@
+# Copyright 2012, Sean B. Palmer
+# Code at http://inamidst.com/duxlot/
+# Apache License 2.0
+
+import bisect
+import json
+import multiprocessing
+import os
+import time
+
+# Save PEP 3122!
+if "." in __name__:
+    from . import storage
+else:
+    import storage
+
+# Bucket upper bounds, ten per decade from a microsecond to a thousand
+# seconds, so percentiles are within about a quarter of the true value
+bounds = [10 ** (exponent / 10) for exponent in range(-60, 31)]
+
+# Stages of the message pipeline, in order. A message is stamped when it's
+# received, dequeued by process:messages, and parsed. The queue stage is from
+# receipt to dequeueing, events is dispatching its events, and spawn is from
+# parsing to its command starting. Each command's run is command:<name>. Sent
+# lines are stamped when enqueued, and send is from then until the socket
+# write, and reply is from receipt of the original message until then
+stages = ("queue", "parse", "events", "spawn", "send", "reply")
+
+class Histogram(object):
+    "Counts of durations in logarithmic buckets"
+    __slots__ = ("counts", "total", "maximum")
+
+    def __init__(self, state=None):
+        if state is None:
+            self.counts = [0] * (len(bounds) + 1)
+            self.total = 0.0
+            self.maximum = 0.0
+        else:
+            counts, self.total, self.maximum = state
+            self.counts = list(counts)
+
+    def state(self):
+        return (self.counts, self.total, self.maximum)
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(bounds, seconds)] += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+
+    def count(self):
+        return sum(self.counts)
+
+    def percentile(self, percent):
+        "Upper bound of the bucket holding the given percentile"
+        wanted = self.count() * percent / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and (seen >= wanted):
+                if index < len(bounds):
+                    return min(bounds[index], self.maximum)
+                return self.maximum
+        return 0.0
+
+    def summary(self):
+        count = self.count()
+        return {
+            "count": count,
+            "mean": (self.total / count) if count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.maximum
+        }
+
+class Recorder(object):
+    "Histograms recorded in each process, and merged into a shared store"
+
+    def __init__(self, interval=5):
+        self.interval = interval
+        # Flushed as commands exit, which is when they are killed
+        self.lock = storage.RecordLock()
+        self.store = None
+        # Receive stamp of the message being handled in this process
+        self.origin = None
+        self.reset()
+        storage.after_fork(self.reset, self.finalise)
+
+    def reset(self):
+        # Histograms inherited from the parent were already counted there
+        self.local = {}
+        self.flushed = time.time()
+
+    def finalise(self):
+        import multiprocessing.util
+        self.reset()
+        multiprocessing.util.Finalize(self, self.flush, exitpriority=10)
+
+    def record(self, name, seconds):
+        if name not in self.local:
+            self.local[name] = Histogram()
+        self.local[name].record(max(seconds, 0.0))
+
+        if (time.time() - self.flushed) >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self.flushed = time.time()
+        if (self.store is None) or (not self.local):
+            return
+
+        local, self.local = self.local, {}
+        try:
+            with self.lock:
+                for name, histogram in local.items():
+                    if name in self.store:
+                        histogram.merge(Histogram(self.store[name]))
+                    self.store[name] = histogram.state()
+        except (IOError, EOFError):
+            # The manager has gone, so there's nowhere to put these
+            ...
+
+    def histograms(self):
+        return {name: Histogram(state) for name, state in self.store.items()}
+
+    def clear(self):
+        with self.lock:
+            self.store.clear()
+
+    def dump(self, filename):
+        summaries = {}
+        for name, histogram in self.histograms().items():
+            summaries[name] = histogram.summary()
+
+        temporary = filename + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump({"time": time.time(), "latency": summaries}, f,
+                indent=2, sort_keys=True)
+        os.replace(temporary, filename)
+
+recorder = Recorder()
+record = recorder.record
+
+def account(costs, name, cost, weight=0.1):
+    "Fold the cost of one run of a command into its moving averages"
+    if name not in costs:
+        averages = dict(cost)
+        averages["runs"] = 0
+    else:
+        averages = costs[name]
+        for key, value in cost.items():
+            current = averages.get(key, value)
+            averages[key] = current + (weight * (value - current))
+    averages["runs"] += 1
+    costs[name] = averages
+
+def milliseconds(seconds):
+    if seconds < 0.01:
+        return "%.2fms" % (seconds * 1000)
+    return "%sms" % round(seconds * 1000, 1)
+
+### Exposition ###
+
+def exposition(families):
+    """Format (name, kind, help, samples) families in the Prometheus text
+    format, where samples are (suffix, labels, value) tuples"""
+    def quote(value):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n")
+        return '"' + value.replace('"', '\\"') + '"'
+
+    lines = []
+    for name, kind, description, samples in families:
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for suffix, labels, value in samples:
+            if labels:
+                pairs = ",".join("%s=%s" % (key, quote(labels[key]))
+                    for key in sorted(labels))
+                labels = "{" + pairs + "}"
+            else:
+                labels = ""
+            lines.append("%s%s%s %r" % (name, suffix, labels, float(value)))
+    return "\n".join(lines) + "\n"
+
+def summaries(name, description, label, histograms):
+    "A summary family of the given histograms, keyed by the label"
+    samples = []
+    for key in sorted(histograms):
+        histogram = histograms[key]
+        for quantile in (50, 95, 99):
+            labels = {label: key, "quantile": quantile / 100}
+            samples.append(("", labels, histogram.percentile(quantile)))
+        samples.append(("_sum", {label: key}, histogram.total))
+        samples.append(("_count", {label: key}, histogram.count()))
+    return (name, "summary", description, samples)
+
+class Endpoint(object):
+    "Serves metrics over HTTP, on host:port or a unix socket path"
+
+    def __init__(self, address, collect):
+        import http.server
+        import socketserver
+        import threading
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in {"/", "/metrics"}:
+                    return self.send_error(404)
+
+                body = exposition(collect()).encode("utf-8")
+                self.send_response(200)
+                kind = "text/plain; version=0.0.4; charset=utf-8"
+                self.send_header("Content-Type", kind)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes would otherwise fill the log
+                ...
+
+        self.address = address
+        if "/" in address:
+            class Server(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+                daemon_threads = True
+
+            if os.path.exists(address):
+                os.remove(address)
+            self.server = Server(address, Handler)
+        else:
+            class Server(socketserver.ThreadingMixIn,
+                    socketserver.TCPServer):
+                allow_reuse_address = True
+                daemon_threads = True
+
+            host, port = address.rsplit(":", 1)
+            self.server = Server((host or "localhost", int(port)), Handler)
+
+        # Forked processes mustn't keep the listening socket open
+        storage.after_fork(self.server.socket.close)
+
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if "/" in self.address:
+            try: os.remove(self.address)
+            except OSError:
+                ...
+
+### Monitoring ###
+
+def stat(pid):
+    "Fields of /proc/<pid>/stat from the state on, as the name may have spaces"
+    with open("/proc/%s/stat" % pid, encoding="ascii") as f:
+        return f.read().rsplit(")", 1).pop().split()
+
+class Monitor(object):
+    "Samples the CPU, RSS, open files, and queue depth of processes"
+    # Only Linux has the /proc files that this reads
+    available = os.path.isfile("/proc/self/stat")
+
+    def __init__(self, length=60):
+        import collections
+
+        self.length = length
+        # Name to (time, cpu percent, rss bytes, fds, depth) samples
+        self.history = collections.OrderedDict()
+        self.ticks = {}
+        self.alerted = set()
+
+    def stat(self, pid):
+        fields = stat(pid)
+        ticks = int(fields[11]) + int(fields[12])
+        rss = int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+        fds = len(os.listdir("/proc/%s/fd" % pid))
+        return ticks, rss, fds
+
+    def sample(self, pids, depths=None):
+        "Sample named PIDs, forgetting the history of any not named"
+        import collections
+
+        depths = depths or {}
+        now = time.time()
+        ticks = {}
+        for name, pid in pids.items():
+            try: used, rss, fds = self.stat(pid)
+            except (IOError, OSError, IndexError, ValueError):
+                continue
+
+            cpu = 0.0
+            if pid in self.ticks:
+                before, previous = self.ticks[pid]
+                if now > before:
+                    seconds = (used - previous) / os.sysconf("SC_CLK_TCK")
+                    cpu = 100 * seconds / (now - before)
+            ticks[pid] = (now, used)
+
+            if name not in self.history:
+                self.history[name] = collections.deque(maxlen=self.length)
+            sample = (now, cpu, rss, fds, depths.get(name, 0))
+            self.history[name].append(sample)
+        self.ticks = ticks
+
+        for name in [name for name in self.history if name not in pids]:
+            del self.history[name]
+
+    def latest(self, name):
+        return self.history[name][-1]
+
+    def growth(self, name):
+        "RSS growth in bytes across the history of a process"
+        history = self.history[name]
+        return history[-1][2] - history[0][2]
+
+    def alerts(self, limits):
+        """Messages about limits newly exceeded, where limits has cpu, rss,
+        fds, depth, and growth, a percentage of the oldest RSS in history"""
+        exceeded = set()
+        messages = []
+        for name, history in self.history.items():
+            when, cpu, rss, fds, depth = history[-1]
+            oldest = history[0][2]
+            checks = (
+                ("cpu", cpu, "%s%% CPU" % round(cpu)),
+                ("rss", rss / 1048576, "%sMB RSS" % round(rss / 1048576)),
+                ("fds", fds, "%s open files" % fds),
+                ("depth", depth, "%s queued" % depth),
+                ("growth", (100 * (rss - oldest) / oldest) if oldest else 0,
+                    "RSS up %sMB since %s" % (round((rss - oldest) / 1048576),
+                    time.strftime("%H:%M", time.gmtime(history[0][0]))))
+            )
+            for kind, value, text in checks:
+                if limits.get(kind) and (value > limits[kind]):
+                    exceeded.add((name, kind))
+                    if (name, kind) not in self.alerted:
+                        messages.append("%s: %s" % (name, text))
+
+        # Each is only alerted again after it has recovered
+        self.alerted = exceeded
+        return messages
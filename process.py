@@ -2,11 +2,14 @@
 # Code at http://inamidst.com/duxlot/
 # Apache License 2.0
 
+import collections
+import heapq
 import multiprocessing
+import multiprocessing.connection
 import os
 import signal
 import socket
-import sys
+import threading
 import time
 
 # Save PEP 3122!
@@ -15,6 +18,10 @@ if "." in __name__:
 else:
     import storage
 debug = storage.output.write
+# Deadlines are on this clock, so that tests can advance past them
+clock = storage.clock
+counters = storage.counters
+RecordLock = storage.RecordLock
 del storage
 
 pids = set()
@@ -24,6 +31,19 @@ def killall():
         try: os.kill(pid, signal.SIGKILL)
         except: ...
 
+def snapshot_filename(pid):
+    import tempfile
+    return os.path.join(tempfile.gettempdir(), "duxlot-%s.snapshot" % pid)
+
+def snapshot(signum, frame):
+    "Dump a tracemalloc snapshot for test/soak.py, if tracing"
+    import tracemalloc
+
+    if tracemalloc.is_tracing():
+        filename = snapshot_filename(os.getpid())
+        tracemalloc.take_snapshot().dump(filename + ".tmp")
+        os.replace(filename + ".tmp", filename)
+
 class Process(object):
     def __init__(self, name):
         self.name = name
@@ -53,6 +73,7 @@ class Process(object):
             signal.signal(signal.SIGINT, signal.SIG_IGN)
             # This must be IGN
             signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+            signal.signal(signal.SIGUSR2, snapshot)
 
             self.inactive.clear()
             try: self.function(self.private, self.public)  # @@ freeze?
@@ -230,13 +251,202 @@ class Processes(object):
     def number(self):
         return len(multiprocessing.active_children())
 
+class Admission(object):
+    "Bounded queue of pending commands, served round robin by user"
+
+    def __init__(self, processes=18, user=3, queue=36):
+        self.processes = processes
+        self.user = user
+        self.queue = queue
+        self.pending = collections.OrderedDict() # key to deque
+        self.size = 0
+
+    def user_of(self, key):
+        # Keys are (channel, nick), with the nick the part that is limited
+        return key[-1] if key else None
+
+    def add(self, key, item):
+        "Queue an item, or return False if there is no room for it"
+        if self.size >= self.queue:
+            return False
+
+        if key is not None:
+            user = self.user_of(key)
+            waiting = 0
+            for other, items in self.pending.items():
+                if self.user_of(other) == user:
+                    waiting += len(items)
+            if waiting >= self.user:
+                return False
+
+        self.pending.setdefault(key, collections.deque()).append(item)
+        self.size += 1
+        return True
+
+    def next(self, running):
+        "Take the next item from a key whose user is below the limit"
+        for key in list(self.pending):
+            user = self.user_of(key)
+            if (user is not None) and (running[user] >= self.user):
+                continue
+
+            items = self.pending.pop(key)
+            item = items.popleft()
+            # Keys go to the back of the rotation after being served
+            if items:
+                self.pending[key] = items
+            self.size -= 1
+            return item
+
+class Supervisor(object):
+    "Admit commands, kill them at their deadlines, and reap them on exit"
+
+    def __init__(self, commands):
+        self.commands = commands
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.admission = Admission(*commands.limits)
+        self.deadlines = [] # heap of (deadline, name)
+        self.running = {}
+        self.users = collections.Counter()
+        self.wakeup, self.notify = os.pipe()
+        self.stopping = False
+
+        self.thread = threading.Thread(target=self.run, name="supervisor")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, function, public, timeout, key):
+        item = (clock.time(), function, public, timeout, key)
+        with self.lock:
+            admitted = self.admission.add(key, item)
+        if not admitted:
+            debug("Command failed: too many pending commands")
+            self.commands.count("admission-rejected")
+            return False
+
+        self.dispatch()
+        return True
+
+    def dispatch(self):
+        "Start pending commands while there is capacity for them"
+        with self.lock:
+            while self.admission.size:
+                if len(self.commands.known) >= self.admission.processes:
+                    break
+
+                item = self.admission.next(self.users)
+                if item is None:
+                    break
+
+                queued, function, public, timeout, key = item
+                # Safe to fork here, as threads only write to log buffers,
+                # under locks that are made anew in the child
+                name, process, deadline = self.commands.start(
+                    function, public, timeout
+                )
+
+                user = self.admission.user_of(key)
+                self.running[name] = (process, user)
+                self.users[user] += 1
+                heapq.heappush(self.deadlines, (deadline, name))
+
+                waited = clock.time() - queued
+                self.commands.count("admission-admitted")
+                self.commands.count("admission-waited", waited)
+                statistics = self.commands.statistics
+                if waited > statistics.get("admission-longest", 0):
+                    statistics["admission-longest"] = waited
+        os.write(self.notify, b".")
+
+    def stop(self):
+        # The thread mustn't die holding Commands.lock when the process exits
+        with self.lock:
+            self.stopping = True
+        os.write(self.notify, b".")
+        self.thread.join(6)
+
+    def run(self):
+        while True:
+            with self.lock:
+                if self.stopping:
+                    break
+                sentinels = {}
+                for name, (process, user) in self.running.items():
+                    sentinels[process.sentinel] = name
+                if self.deadlines:
+                    timeout = max(0, self.deadlines[0][0] - clock.time())
+                    timeout = clock.timeout(timeout)
+                else:
+                    timeout = None
+                # Capacity freed in other processes isn't signalled here
+                if self.admission.size:
+                    timeout = 1 if (timeout is None) else min(timeout, 1)
+
+            objects = [self.wakeup] + list(sentinels)
+            for ready in multiprocessing.connection.wait(objects, timeout):
+                if ready == self.wakeup:
+                    os.read(self.wakeup, 4096)
+                else:
+                    self.exited(sentinels[ready])
+
+            self.expire(clock.time())
+            if self.admission.size:
+                self.dispatch()
+
+    def remove(self, name):
+        with self.lock:
+            process, user = self.running.pop(name, (None, None))
+            if process is not None:
+                self.users[user] -= 1
+        return process
+
+    def exited(self, name):
+        process = self.remove(name)
+        if process is not None:
+            self.reap(process)
+            # In case the command died without cleaning up after itself
+            self.commands.forget(name)
+
+    def expire(self, current):
+        while True:
+            with self.lock:
+                if not self.deadlines:
+                    break
+                if self.deadlines[0][0] > current:
+                    break
+                deadline, name = heapq.heappop(self.deadlines)
+            process = self.remove(name)
+
+            # Commands that have already exited are just skipped
+            if process is not None:
+                debug("Sending SIGKILL to", name, "at its deadline")
+                try: os.kill(process.pid, signal.SIGKILL)
+                except OSError: ...
+                self.reap(process)
+                self.commands.forget(name)
+
+    def reap(self, process):
+        process.join()
+        pids.discard(process.pid)
+        # Closing releases the sentinel, so descriptors don't pile up
+        try: process.close()
+        except (AttributeError, ValueError):
+            ...
+
 class Commands(object):
     def __init__(self, manager):
-        self.lock = multiprocessing.Lock()
+        # Commands take this as they exit, which is when they are killed
+        self.lock = RecordLock()
         self.number = manager.Value("i", 0)
         self.active = manager.Value("i", 0)
         self.known = manager.dict()
         self.pid = manager.dict()
+        self.timeout = 60
+        self.limits = (18, 3, 36)
+        self.statistics = {}
+        # Each process that spawns commands gets its own supervisor
+        self.supervisor = None
 
     def __contains__(self, name):
         return name in self.known
@@ -254,19 +464,40 @@ class Commands(object):
             if process.name.startswith("Command "):
                 yield process
 
-    def spawn(self, function, public):
-        if self.active.value >= 18:
-            debug("Command failed: too many active processes")
-            return False
+    def admit(self, processes, user, queue):
+        "Set the admission limits for commands spawned by this process"
+        self.limits = (processes, user, queue)
+        if self.supervisor is not None:
+            with self.supervisor.lock:
+                admission = self.supervisor.admission
+                admission.processes = processes
+                admission.user = user
+                admission.queue = queue
+
+    def stop(self):
+        "Stop the supervisor of this process, before the process exits"
+        if self.supervisor is not None:
+            if self.supervisor.pid == os.getpid():
+                self.supervisor.stop()
 
+    def count(self, key, amount=1):
+        counters.add(self.statistics, key, amount)
+
+    def spawn(self, function, public, timeout=None, key=None):
+        "Run function(public) in a new process, once admitted"
+        if (self.supervisor is None) or (self.supervisor.pid != os.getpid()):
+            self.supervisor = Supervisor(self)
+        return self.supervisor.submit(function, public, timeout, key)
+
+    def start(self, function, public, timeout=None):
         def process(self, name, function, public):
             # global pids
 
             debug(name, "starting")
             with self.lock:
                 self.active.value += 1
-                created = self.known[name][0]
-                self.known[name] = [created, time.time()]
+                created, started, deadline = self.known[name]
+                self.known[name] = [created, clock.time(), deadline]
 
             def cleanup():
                 try: 
@@ -297,8 +528,12 @@ class Commands(object):
         with self.lock:
             self.number.value += 1
 
+        if timeout is None:
+            timeout = self.timeout
+
         name = "Command %05i" % self.number.value
-        self.known[name] = [time.time(), False]
+        created = clock.time()
+        self.known[name] = [created, False, created + timeout]
         p = multiprocessing.Process(
             target=process,
             name=name,
@@ -307,10 +542,18 @@ class Commands(object):
         p.start()
         self.pid[name] = p.pid
         pids.add(p.pid)
+        return name, p, created + timeout
 
-        # time.time() + 60
-        # self.schedule
-        return name
+    def forget(self, name):
+        "Remove the records of a command that can no longer clean up"
+        try:
+            with self.lock:
+                if name in self.known:
+                    self.active.value -= 1
+                    del self.known[name]
+                self.pid.pop(name, None)
+        except (IOError, EOFError):
+            ...
 
     def terminate_command(self, name):
         pid = self.pid.get(name)
@@ -327,41 +570,42 @@ class Commands(object):
                 except OSError: ...
 
             pids.discard(pid)
-            del self.known[name]
-            del self.pid[name]
+            self.forget(name)
             return True
 
         debug("Couldn't SIGKILL %s!" % name)
         return False
 
-    def collect(self, timeout=60):
+    # Supervisors normally kill commands at their deadlines. These methods
+    # are for restarts, and for commands whose supervisor has gone away
+    def expired(self, info, current, timeout):
+        created, started, deadline = info
+        if not started:
+            return False
+        if timeout is None:
+            return current > deadline
+        return current > (started + timeout)
+
+    def collect(self, timeout=None):
         count = 0
-        current = time.time()
+        current = clock.time()
 
         items = list(self.known.items())
         for name, info in items:
-            created, started = info
-            if not started:
-                continue
-
-            # @@ if (started - created) > N, penalise less
-            if current > (started + timeout):
+            if self.expired(info, current, timeout):
                 terminated = self.terminate_command(name)
                 if terminated:
                     count += 1
 
         return count
 
-    def collectable(self, timeout=60):
+    def collectable(self, timeout=None):
         count = 0
-        current = time.time()
+        current = clock.time()
 
         items = list(self.known.items())
         for name, info in items:
-            created, started = info
-            if not started:
-                continue
-            if current > (started + timeout):
+            if self.expired(info, current, timeout):
                 count += 1
 
         debug("Collectable:", count, "of", len(items))
@@ -0,0 +1,211 @@
+# Copyright 2012, Sean B. Palmer
+# Code at http://inamidst.com/duxlot/
+# Apache License 2.0
+
+import multiprocessing
+import os
+import random
+import time
+
+import duxlot
+
+# Not called profile.py, which would shadow the module that cProfile uses
+
+class Profiler(object):
+    "Profiles a fraction of commands, or a pipeline process, to pstats files"
+    processes = ("receive", "send", "messages", "events")
+
+    def __init__(self, interval=30):
+        self.interval = interval
+        # Set by the options in the bot process, and read by every other
+        self.fraction = multiprocessing.Value("d", 0.0, lock=False)
+        # One more than the index of the process to profile, or zero
+        self.target = multiprocessing.Value("i", 0, lock=False)
+        # Commands save their profiles as they exit, so may be killed then
+        self.lock = duxlot.RecordLock()
+        self.directory = None
+        self.reset()
+        duxlot.after_fork(self.reset)
+
+    def reset(self):
+        # The profile of the pipeline process this is, if it's profiled
+        self.profile = None
+        self.saved = 0
+
+    def configure(self, fraction=None, process=None):
+        if fraction is not None:
+            self.fraction.value = min(max(fraction, 0.0), 1.0)
+        if process is not None:
+            if process:
+                self.target.value = self.processes.index(process) + 1
+            else:
+                self.target.value = 0
+
+    def filename(self, name):
+        return os.path.join(self.directory, name + ".prof")
+
+    def names(self):
+        if (self.directory is None) or (not os.path.isdir(self.directory)):
+            return []
+        return sorted(name[:-5] for name in os.listdir(self.directory)
+            if name.endswith(".prof"))
+
+    def save(self, name, profile):
+        "Add a profile to the aggregate profile of that name"
+        import pstats
+
+        if self.directory is None:
+            return
+
+        try: stats = pstats.Stats(profile)
+        except TypeError:
+            # Nothing was recorded
+            return
+
+        with self.lock:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            filename = self.filename(name)
+            if os.path.isfile(filename):
+                stats.add(filename)
+            stats.dump_stats(filename + ".tmp")
+            os.replace(filename + ".tmp", filename)
+
+    def clear(self):
+        with self.lock:
+            for name in self.names():
+                os.remove(self.filename(name))
+
+    def sample(self):
+        "Start profiling a command run, if it's one of the sampled fraction"
+        fraction = self.fraction.value
+        if (not fraction) or (random.random() >= fraction):
+            return None
+
+        import cProfile
+
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def sampled(self, name, profile):
+        profile.disable()
+        self.save("command-" + name, profile)
+
+    def check(self, name):
+        "Start, stop, or save profiling of this pipeline process as needed"
+        target = self.target.value
+        wanted = target and (self.processes[target - 1] == name)
+
+        if wanted and (self.profile is None):
+            import cProfile
+
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            self.saved = time.time()
+        elif (self.profile is not None) and ((not wanted) or
+                ((time.time() - self.saved) >= self.interval)):
+            self.profile.disable()
+            self.save("process-" + name, self.profile)
+            self.profile = None
+            # Start again with a fresh profile, if still wanted
+            if wanted:
+                self.check(name)
+
+    def finish(self, name):
+        if self.profile is not None:
+            self.profile.disable()
+            self.save("process-" + name, self.profile)
+            self.profile = None
+
+    def top(self, name, limit=5):
+        "Total seconds, and the functions taking the most internal time"
+        import pstats
+
+        stats = pstats.Stats(self.filename(name))
+        functions = []
+        for (path, line, function), item in stats.stats.items():
+            calls, internal = item[1], item[2]
+            if path == "~":
+                # Builtins, such as {method 'recv' of '_socket.socket'}
+                label = function
+            else:
+                label = "%s:%s(%s)" % (os.path.basename(path), line, function)
+            functions.append((internal, calls, label))
+        functions.sort(reverse=True)
+        return stats.total_tt, functions[:limit]
+
+profiler = Profiler()
+
+class Watchdog(object):
+    "Logs where a command is, when it's slow and again before it's killed"
+
+    def __init__(self):
+        # Seconds before a command is slow, shared between processes
+        self.threshold = multiprocessing.Value("d", 10.0, lock=False)
+        # Stacks are written just before commands are killed
+        self.lock = duxlot.RecordLock()
+        self.filename = None
+
+    def configure(self, threshold=None):
+        if threshold is not None:
+            self.threshold.value = threshold
+
+    def watch(self, env, killed):
+        """Watch the command running in this thread, and return an event to
+        set when it's done, or None if slow commands aren't being logged"""
+        import sys
+        import threading
+
+        threshold = self.threshold.value
+        if (not threshold) or (self.filename is None):
+            return None
+
+        ident = threading.get_ident()
+        # Frames above the caller were inherited from forking processes
+        caller = sys._getframe(1)
+        started = time.time()
+        # The supervisor kills the command at killed, a timestamp
+        moments = [started + threshold]
+        if (killed - 1) > moments[0]:
+            moments.append(killed - 1)
+
+        done = threading.Event()
+        def bark():
+            for moment in moments:
+                if done.wait(max(moment - time.time(), 0)):
+                    return
+                self.record(env, ident, caller, time.time() - started)
+
+        thread = threading.Thread(target=bark)
+        thread.daemon = True
+        thread.start()
+        return done
+
+    def record(self, env, ident, caller, elapsed):
+        import sys
+        import traceback
+
+        frame = sys._current_frames().get(ident)
+        frames = []
+        while frame is not None:
+            frames.append((frame, frame.f_lineno))
+            if frame is caller:
+                break
+            frame = frame.f_back
+        stack = traceback.StackSummary.extract(reversed(frames))
+
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        args = (when, env.command, env.nick, env.sender, round(elapsed, 1),
+            os.getpid())
+        lines = ["%s slow: %s by %s in %s, after %ss (pid %s)\n" % args]
+        lines.append("Arguments: %r\n" % env.arg)
+        lines.extend(stack.format())
+        lines.append("\n")
+
+        duxlot.output.write(lines[0].rstrip("\n"), level="warning")
+        with self.lock:
+            with open(self.filename, "a", encoding="utf-8") as f:
+                f.write("".join(lines))
+
+watchdog = Watchdog()
@@ -0,0 +1,181 @@
+# Copyright 2012, Sean B. Palmer
+# Code at http://inamidst.com/duxlot/
+# Apache License 2.0
+
+import marshal
+import multiprocessing
+import platform
+import queue
+import struct
+import time
+
+try: from multiprocessing import shared_memory
+except ImportError:
+    # Python 3.8 and later only
+    shared_memory = None
+
+# Records are published by a plain store of HEAD after them, without any
+# barrier, which is only safe where stores aren't reordered, as on x86
+x86 = platform.machine().lower() in {"x86_64", "amd64", "i386", "i686", "x86"}
+available = (shared_memory is not None) and x86
+
+# Save PEP 3122!
+if "." in __name__:
+    from . import api
+else:
+    import api
+
+# Header words, each on its own cache line
+HEAD = 0 # Bytes ever written, only stored by the producer
+TAIL = 8 # Bytes ever read, only stored by the consumer
+WAITING = 16 # Set by the consumer when it's about to sleep
+STOP = 24 # One more than the HEAD at which to stop, or zero
+PUTS = 32 # Records ever written
+GETS = 40 # Records ever read
+
+def encode(message):
+    # Compact messages are sent as their line, without parsing them here
+    if isinstance(message, api.irc.Message):
+        return marshal.dumps((message.count, message.octets, message.stamp))
+
+    prefix = message["prefix"]
+    return marshal.dumps((
+        message["count"],
+        message["command"],
+        prefix["nick"],
+        prefix["user"],
+        prefix["host"],
+        message["parameters"],
+        message["parameters_octets"],
+        message["octets"]
+    ))
+
+def decode(data):
+    fields = marshal.loads(data)
+    if len(fields) == 3:
+        return api.irc.Message(fields[1], fields[0], fields[2])
+
+    return {
+        "command": fields[1],
+        "prefix": {"nick": fields[2], "user": fields[3], "host": fields[4]},
+        "parameters_octets": fields[6],
+        "parameters": fields[5],
+        "octets": fields[7],
+        "count": fields[0]
+    }
+
+class Ring(object):
+    "Single producer, single consumer queue of IRC messages in shared memory"
+
+    # Records are a length, then the fields of a message in a fixed order,
+    # marshalled. This is smaller and quicker than a pickle
+    record = struct.Struct("<I")
+    offset = 384
+
+    def __init__(self, size=1048576):
+        if not available:
+            raise RuntimeError("Rings need Python 3.8 or later, and x86")
+
+        self.size = size
+        self.memory = shared_memory.SharedMemory(
+            create=True,
+            size=self.offset + size
+        )
+        self.buffer = self.memory.buf
+        # Aligned word stores are atomic
+        self.words = self.buffer[:self.offset].cast("Q")
+        for word in (HEAD, TAIL, WAITING, STOP, PUTS, GETS):
+            self.words[word] = 0
+
+        # Only released when the consumer says that it's waiting
+        self.wakeup = multiprocessing.Semaphore(0)
+
+    def write(self, position, data):
+        start = self.offset + (position % self.size)
+        first = min(len(data), self.offset + self.size - start)
+        self.buffer[start:start + first] = data[:first]
+        if first < len(data):
+            rest = len(data) - first
+            self.buffer[self.offset:self.offset + rest] = data[first:]
+
+    def read(self, position, length):
+        start = self.offset + (position % self.size)
+        first = min(length, self.offset + self.size - start)
+        data = self.buffer[start:start + first].tobytes()
+        if first < length:
+            rest = length - first
+            data += self.buffer[self.offset:self.offset + rest].tobytes()
+        return data
+
+    def put(self, message):
+        if message == "StopIteration":
+            return self.stop()
+
+        data = encode(message)
+        data = self.record.pack(len(data)) + data
+        if len(data) > self.size:
+            raise ValueError("Message larger than the ring")
+
+        # Full rings are rare, so the producer just polls for space
+        head = self.words[HEAD]
+        while (self.size - (head - self.words[TAIL])) < len(data):
+            time.sleep(0.001)
+
+        self.write(head, data)
+        self.words[PUTS] += 1
+        self.words[HEAD] = head + len(data)
+        if self.words[WAITING]:
+            self.wakeup.release()
+
+    def stop(self):
+        "Make the consumer stop once it has read everything before now"
+        # This may be called from any process, unlike put
+        self.words[STOP] = self.words[HEAD] + 1
+        self.wakeup.release()
+
+    def get(self, block=True):
+        while True:
+            tail = self.words[TAIL]
+            stop = self.words[STOP]
+            if stop and (tail >= (stop - 1)):
+                self.words[STOP] = 0
+                return "StopIteration"
+
+            if self.words[HEAD] != tail:
+                size = self.record.size
+                length, = self.record.unpack(self.read(tail, size))
+                data = self.read(tail + size, length)
+                self.words[TAIL] = tail + size + length
+                self.words[GETS] += 1
+                return decode(data)
+
+            if not block:
+                raise queue.Empty
+
+            # The timeout covers a wakeup lost between these two checks
+            self.words[WAITING] = 1
+            if (self.words[HEAD] == tail) and (not self.words[STOP]):
+                self.wakeup.acquire(timeout=0.05)
+            self.words[WAITING] = 0
+
+    def qsize(self):
+        return self.words[PUTS] - self.words[GETS]
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def task_done(self):
+        ...
+
+    def join(self):
+        while self.words[HEAD] != self.words[TAIL]:
+            time.sleep(0.001)
+
+    def close(self):
+        # Only the creating process should call this
+        if self.buffer is None:
+            return
+        self.words.release()
+        self.buffer = None
+        self.memory.close()
+        self.memory.unlink()
@@ -364,6 +364,10 @@ Configuration actions:
     duxlot alias <path> <alias>
     duxlot unalias <alias>
     duxlot config <identifier>
+
+Development actions:
+
+    duxlot [ --output <results> ] [ --tolerance <fraction> ] bench [<baseline>]
 """)
 
 def actions():
@@ -401,6 +405,17 @@ Configuration actions:
 
     duxlot config <identifier>
         Show the config file referred to by <identifier>
+
+Development actions:
+
+    duxlot [--output <results>] [--tolerance <fraction>] bench [<baseline>]
+        Times parsing, environments, event dispatch, storage, the
+        database, options, and some services, and prints the results
+        as JSON, or saves them to <results>. With a <baseline> saved
+        earlier, shows the changes, and fails if anything is more
+        than 25% slower, or slower by <fraction> if given. Runs on a
+        busy machine can vary by more than that, so such machines may
+        need a <fraction> of 1, which allows anything up to twice as slow
 """)
 
 @action
@@ -439,6 +454,10 @@ def start(args):
         print("Error: %s: %s" % (message, args.pidfile))
         return 1
 
+    # The output file is rotated by name, so resolve it before daemonising
+    if args.output not in {None, "-", "/dev/stdout"}:
+        duxlot.output.filename = os.path.abspath(args.output)
+
     if not args.foreground:
         daemonise(args)
         ourpid = os.getpid()
@@ -524,6 +543,50 @@ def create(args):
         print("   " + duxlot.config.default)
         sys.exit(1)
 
+@action
+def bench(args):
+    "Benchmark the per-message path, optionally comparing against a baseline"
+    import json
+
+    if not only(args, {"action", "identifier", "output", "tolerance"}):
+        print("Error: Usage: duxlot [-o <results>] [--tolerance <fraction>] "
+            "bench [<baseline>]")
+        sys.exit(1)
+
+    # Save PEP 3122!
+    if "." in __name__:
+        from . import bench
+    else:
+        import bench
+
+    results = bench.suite()
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+    if args.identifier is None:
+        if not args.output:
+            print(text)
+        return 0
+
+    try:
+        with open(args.identifier, encoding="utf-8") as f:
+            baseline = json.load(f)
+    except (IOError, OSError, ValueError) as err:
+        print("Error: Couldn't read the baseline: %s" % err)
+        return 1
+
+    tolerance = 0.25 if (args.tolerance is None) else args.tolerance
+    lines, slower = bench.compare(results, baseline, tolerance)
+    for line in lines:
+        print(line)
+    if slower:
+        args = (round(tolerance * 100), ", ".join(slower))
+        print("Error: More than %s%% slower than the baseline: %s" % args)
+        return 1
+    return 0
+
 # @@ unused
 def act(args):
     if not only(args, {"act"}):
@@ -634,6 +697,12 @@ def main():
         metavar="FILENAME",
         help="redirect daemon stdout and stderr to this filename"
     )
+    parser.add_argument(
+        "--tolerance",
+        metavar="FRACTION",
+        help="how much slower than the baseline bench may be, default 0.25",
+        type=float
+    )
     parser.add_argument(
         "--actions",
         help="show a long help message about actions",
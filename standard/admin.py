@@ -7,8 +7,10 @@ import duxlot
 # Save PEP 3122!
 if "." in __name__:
     from . import api
+    from . import metrics
 else:
     import api
+    import metrics
 
 command = duxlot.command
 
@@ -141,6 +143,21 @@ def update_unicode_data(env):
 
 ### Admin commands ###
 
+@command
+def admission(env):
+    "Show command admission and queueing statistics"
+    if env.admin.user:
+        admitted = env.data.get("admission-admitted", 0)
+        rejected = env.data.get("admission-rejected", 0)
+        waited = env.data.get("admission-waited", 0)
+        longest = env.data.get("admission-longest", 0)
+        average = (waited / admitted) if admitted else 0
+        msg = "%s admitted, %s rejected, %ss average wait, %ss longest wait"
+        env.reply(msg % (admitted, rejected,
+            round(average, 3), round(longest, 3)))
+    else:
+        env.reply("This is an admin-only command")
+
 @command
 def channel_prefix(env):
     "Set the command prefix for a specific channel"
@@ -167,6 +184,45 @@ def join(env):
             env.options.put("start-channels", channels)
             env.reply("Joined " + env.arg)
 
+@command
+def latency(env):
+    "Show pipeline latency percentiles, or those of a command, or reset them"
+    if env.admin.user:
+        if env.arg == "reset":
+            env.latency.clear()
+            return env.reply("Cleared the latency histograms")
+
+        histograms = env.latency.histograms()
+        if env.arg == "commands":
+            names = [name for name in histograms
+                if name.startswith("command:")]
+            # The slowest first, by 95th percentile
+            names.sort(key=lambda name: -histograms[name].percentile(95))
+            names = names[:8]
+        elif env.arg:
+            names = ["command:" + env.arg]
+        else:
+            names = [name for name in metrics.stages if name in histograms]
+
+        results = []
+        for name in names:
+            if name not in histograms:
+                continue
+            histogram = histograms[name]
+            args = (name.split(":").pop(),
+                metrics.milliseconds(histogram.percentile(50)),
+                metrics.milliseconds(histogram.percentile(95)),
+                metrics.milliseconds(histogram.percentile(99)),
+                histogram.count())
+            results.append("%s %s/%s/%s (%s)" % args)
+
+        if results:
+            env.reply("p50/p95/p99: " + ", ".join(results))
+        else:
+            env.reply("No latencies have been recorded")
+    else:
+        env.reply("This is an admin-only command")
+
 @command
 def me(env):
     "Command the bot to perform an action message"
@@ -242,6 +298,61 @@ def processes(env):
         env.reply("This is an admin-only command")
         # or, Ask an admin to do that
 
+@command
+def profile(env):
+    "Profile a fraction of commands, or a process, or stop: off, or reset"
+    if env.admin.user:
+        profiler = env.profiler
+        if env.arg == "off":
+            env.options.put("profile-commands", 0)
+            env.options.put("profile-process", "")
+            return env.reply("Stopped profiling")
+        elif env.arg == "reset":
+            profiler.clear()
+            return env.reply("Deleted the saved profiles")
+        elif env.arg in profiler.processes:
+            env.options.put("profile-process", env.arg)
+            return env.reply("Profiling process:%s" % env.arg)
+        elif env.arg:
+            try: fraction = float(env.arg)
+            except ValueError:
+                msg = "Usage: profile <fraction>|%s|off|reset"
+                return env.reply(msg % "|".join(profiler.processes))
+            if not (0 <= fraction <= 1):
+                return env.reply("Expected a fraction from 0 to 1")
+            env.options.put("profile-commands", fraction)
+
+        fraction = env.options("profile-commands")
+        process = env.options("profile-process") or "no process"
+        msg = "Profiling %s%% of commands, and %s. Saved: %s"
+        saved = ", ".join(profiler.names()) or "none"
+        env.reply(msg % (round(fraction * 100, 1), process, saved))
+    else:
+        env.reply("This is an admin-only command")
+
+@command
+def profile_top(env):
+    "Show the functions taking the most time in a command or process profile"
+    if env.admin.user:
+        if not env.arg:
+            return env.reply("Usage: profile-top <command>|<process>")
+
+        names = env.profiler.names()
+        for name in ("command-" + env.arg, "process-" + env.arg):
+            if name in names:
+                break
+        else:
+            return env.reply("No profile has been saved for %s" % env.arg)
+
+        total, functions = env.profiler.top(name)
+        results = []
+        for internal, calls, label in functions:
+            share = round(internal / total * 100) if total else 0
+            results.append("%s %s%% (%s calls)" % (label, share, calls))
+        env.reply("%ss: %s" % (round(total, 3), ", ".join(results)))
+    else:
+        env.reply("This is an admin-only command")
+
 @command
 def service(env):
     "Display the results of an internal service call"
@@ -266,6 +377,14 @@ def supercombiner(env):
     else:
         env.reply("This is an admin-only command")
 
+@command
+def top(env):
+    "Show CPU, RSS, open files, and queue depth for each process"
+    if env.admin.user:
+        env.task("top", env.sender, env.nick)
+    else:
+        env.reply("This is an admin-only command")
+
 @command
 def visit(env):
     "Command the bot to visit a new channel temporarily"
@@ -274,6 +393,19 @@ def visit(env):
     elif env.admin.user:
         env.reply("This is an admin and admin-place-only command")
 
+@command
+def web_cache(env):
+    "Show web response cache statistics"
+    if env.admin.user:
+        opt = api.web.cache_statistics()
+        msg = "%s hits, %s revalidated, %s misses, %s negative (%s%% reused)"
+        args = (opt.hits, opt.revalidated, opt.misses, opt.negative,
+            round(opt.ratio * 100, 1))
+        coalesced = env.data.get("flight-coalesced", 0)
+        env.reply(msg % args + ", %s calls coalesced" % coalesced)
+    else:
+        env.reply("This is an admin-only command")
+
 
 ### Events ###
 
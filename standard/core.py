@@ -163,7 +163,27 @@ def seen(env):
 # @@ a check that commands are covered here
 @command
 def stats(env):
-    "Display information about the most used commands"
+    "Display the most used commands, or the costliest: cpu, wall, rss, network"
+    if env.arg:
+        units = {
+            "cpu": (1000, "ms"),
+            "wall": (1000, "ms"),
+            "rss": (1 / 1048576, "MB"),
+            "network": (1 / 1024, "KB")
+        }
+        if env.arg not in units:
+            return env.reply("Usage: stats [cpu|wall|rss|network]")
+        scale, unit = units[env.arg]
+
+        # Moving averages of each run, so recent costs count for most
+        costs = env.database.cache.costs
+        costs = [(b[env.arg], a, b["runs"]) for (a, b) in costs.items()]
+        costs = sorted(costs, reverse=True)[:10]
+        costs = ["%s (%s%s, %s runs)" % (a, round(b * scale, 1), unit, c)
+            for (b, a, c) in costs]
+        return env.reply("Costliest commands by %s: " % env.arg +
+            ", ".join(costs))
+
     usage = env.database.cache.usage
 
     usage = sorted(((b, a) for (a, b) in usage.items()), reverse=True)
@@ -17,6 +17,7 @@ event = duxlot.event
 web_services_manifest = {}
 
 @command
+@duxlot.deadline(60)
 def load_services(env):
     "Load the new services"
     global web_services_manifest
@@ -69,7 +69,7 @@ def pong(env):
 
 @duxlot.event("PONG")
 def received_pong(env):
-    env.data["ponged"] = time.time()
+    env.data["ponged"] = duxlot.clock.time()
 
 @duxlot.startup
 def startup(public):
@@ -34,6 +34,16 @@ def cache_data(public):
     api.clock.cache_timezones_data()
     api.unicode.cache_unicode_data()
 
+@duxlot.startup
+def configure_api(public):
+    # Command processes share responses and flights through the filesystem
+    base = duxlot.config.base(public.options.filename)
+    api.web.options.cache_directory = base + ".web-cache"
+    api.web.options.cache_statistics = public.data
+    api.web.options.fixtures_directory = base + ".fixtures"
+    api.flight.directory = base + ".flight"
+    api.flight.statistics = public.data
+
 @duxlot.startup
 def create_api_commands(public):
     services = api.text()
@@ -66,14 +76,22 @@ def create_api_commands(public):
                     a, b = zone_from_nick(env, env.nick)
                     arg = ":%s :%s %s" % (a, b, arg)
 
-                # @@ Service type? (irc, web, etc.)
-                text = services[name](
-                    text=arg,
-                    maximum={
-                        "bytes": limit,
-                        "lines": 3
-                    }
-                )
+                def call():
+                    # @@ Service type? (irc, web, etc.)
+                    return services[name](
+                        text=arg,
+                        maximum={
+                            "bytes": limit,
+                            "lines": 3
+                        }
+                    )
+
+                # Bursts of the same link command share one call
+                if arg and takes(services[name], "link"):
+                    key = "text.%s\n%s\n%s" % (name, limit, arg)
+                    text = api.coalesce(key, call)
+                else:
+                    text = call()
 
                 found_links = api.regex_link.findall(text)
                 if found_links:
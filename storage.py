@@ -40,7 +40,366 @@ class FrozenStorage(Storage):
     def __setattr__(self, name, value):
         raise AttributeError("'FrozenStorage' attributes cannot be set")
 
+def after_fork(reset, finalise=None):
+    """Calls reset in the children of forks, e.g. to drop state that belongs
+    to the parent, and the bound method finalise in processes that
+    multiprocessing starts"""
+    import multiprocessing.util
+    import os
+
+    # Not available on some platforms, where children keep the parent state
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=reset)
+    if finalise is not None:
+        # Commands and pipeline processes don't run atexit functions
+        owner, function = finalise.__self__, finalise.__func__
+        multiprocessing.util.register_after_fork(owner, function)
+
+class Clock(object):
+    """The time, which is real unless the clock is frozen, after which it only
+    moves when advanced. Tests advance it to fast-forward the schedule"""
+
+    def __init__(self, poll=0.001):
+        import multiprocessing
+
+        # Real seconds between checks of a frozen clock when sleeping on it
+        self.poll = poll
+        # Shared, so that advancing the clock affects every process at once
+        self.frozen = multiprocessing.Value("b", 0, lock=False)
+        self.virtual = multiprocessing.Value("d", 0.0, lock=False)
+        # Sleeps begun on the frozen clock, so that whatever advances it can
+        # tell when a sleeper has finished its work and is waiting again
+        self.slept = multiprocessing.Value("q", 0, lock=False)
+
+    def time(self):
+        if self.frozen.value:
+            return self.virtual.value
+        import time
+        return time.time()
+
+    def freeze(self, at=None):
+        "Stop the clock, at the current time unless given another"
+        import time
+        self.virtual.value = time.time() if (at is None) else at
+        self.frozen.value = 1
+
+    def thaw(self):
+        self.frozen.value = 0
+
+    def advance(self, seconds):
+        if not self.frozen.value:
+            raise ValueError("Only a frozen clock can be advanced")
+        self.virtual.value += seconds
+
+    def sleep(self, seconds):
+        import time
+        if not self.frozen.value:
+            time.sleep(seconds)
+            return
+
+        # Returns early if the clock is thawed
+        until = self.virtual.value + seconds
+        self.slept.value += 1
+        while self.frozen.value and (self.virtual.value < until):
+            time.sleep(self.poll)
+
+    def timeout(self, seconds):
+        "Real seconds to block for when waiting on something for this long"
+        if self.frozen.value and (seconds is not None):
+            # Blocking for longer would miss the clock being advanced
+            return min(seconds, self.poll)
+        return seconds
+
+class RecordLock(object):
+    """A lock between processes, which the kernel releases when its holder
+    dies, as commands do when killed at their deadlines. A killed holder of
+    a multiprocessing.Lock would leave it held for good"""
+
+    def __init__(self):
+        import tempfile
+
+        # Record locks are per process, and aren't inherited by children
+        self.file = tempfile.TemporaryFile()
+        self.reset()
+        after_fork(self.reset)
+
+    def reset(self):
+        import threading
+        # Record locks don't exclude other threads of the same process
+        self.threads = threading.Lock()
+
+    def __enter__(self):
+        import fcntl
+
+        self.threads.acquire()
+        try: fcntl.lockf(self.file, fcntl.LOCK_EX)
+        except BaseException:
+            self.threads.release()
+            raise
+        return self
+
+    def __exit__(self, *exception):
+        import fcntl
+
+        try: fcntl.lockf(self.file, fcntl.LOCK_UN)
+        finally:
+            self.threads.release()
+
+class Counters(object):
+    """Adds to counters in dicts that processes share through a manager,
+    which have no atomic increment of their own"""
+
+    def __init__(self):
+        self.lock = RecordLock()
+
+    def add(self, counters, name, amount=1):
+        with self.lock:
+            try: counters[name] = counters.get(name, 0) + amount
+            except (IOError, EOFError):
+                # Manager dicts fail once the manager has gone away
+                ...
+
+class Output(object):
+    "Logging through per-process buffers to a single writer thread"
+    levels = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+    def __init__(self):
+        import atexit
+        import multiprocessing
+
+        # Only used directly until a writer is started, e.g. in scripts
+        self.lock = multiprocessing.RLock()
+
+        # Shared, so that changing these affects every process at once
+        self.level = multiprocessing.Value("i", 10, lock=False)
+        self.sampling = multiprocessing.Value("i", 1, lock=False)
+        self.maximum = multiprocessing.Value("q", 0, lock=False)
+        self.backups = multiprocessing.Value("i", 3, lock=False)
+        self.dropped = multiprocessing.Value("i", 0)
+
+        self.filename = None
+        # Size of the output file at which to try again after a failed
+        # rotation, so that a failure is neither retried per write nor fatal
+        self.retry = 0
+        self.pipe = None
+        self.reading = None
+        self.reset()
+
+        after_fork(self.reset, self.finalise)
+        atexit.register(self.close)
+
+    def reset(self):
+        import os
+        import threading
+
+        # Each process has its own buffer, and its own thread to flush it
+        self.pid = os.getpid()
+        self.buffer = []
+        self.size = 0
+        self.counts = {}
+        self.flushed = 0
+        self.buffering = threading.Lock()
+        self.flusher = None
+
+    def finalise(self):
+        import multiprocessing.util
+        self.reset()
+        multiprocessing.util.Finalize(self, self.flush, exitpriority=10)
+
+    def configure(self, level=None, sample=None, maximum=None, backups=None):
+        if level is not None:
+            self.level.value = self.levels[level]
+        if sample is not None:
+            self.sampling.value = max(1, sample)
+        if maximum is not None:
+            self.maximum.value = maximum
+        if backups is not None:
+            self.backups.value = backups
+
+    def write(self, *args, level="debug", sample=None, **kargs):
+        import io
+        import threading
+        import time
+
+        if self.levels[level] < self.level.value:
+            return
+
+        # Only every nth line of each sampled kind is logged
+        if sample is not None:
+            count = self.counts.get(sample, 0)
+            self.counts[sample] = count + 1
+            if count % self.sampling.value:
+                return
+
+        if self.pipe is None:
+            with self.lock:
+                print(*args, **kargs)
+            return
+
+        line = io.StringIO()
+        print(*args, file=line, **kargs)
+        line = line.getvalue().encode("utf-8", "replace")
+        # Lines must fit in one atomic pipe write
+        if len(line) > 4000:
+            line = line[:3996] + b"...\n"
+
+        with self.buffering:
+            self.buffer.append(line)
+            self.size += len(line)
+            # Only bursts are buffered, which keeps most lines in order
+            full = self.size >= 2048
+            full = full or ((time.time() - self.flushed) >= 0.1)
+
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.flushing)
+                self.flusher.daemon = True
+                self.flusher.start()
+
+        if full or (level != "debug"):
+            self.flush()
+
+    def flushing(self):
+        import time
+        while True:
+            time.sleep(0.1)
+            self.flush()
+
+    def flush(self):
+        import os
+        import time
+
+        if self.pipe is None:
+            return
+
+        with self.buffering:
+            lines = self.buffer
+            self.buffer = []
+            self.size = 0
+            self.flushed = time.time()
+
+        # Each chunk is whole lines, and at most PIPE_BUF, so it is written
+        # atomically, and never interleaved with other processes' lines
+        while lines:
+            chunk = []
+            size = 0
+            while lines and ((size + len(lines[0])) <= 4096):
+                size += len(lines[0])
+                chunk.append(lines.pop(0))
+
+            try: os.write(self.pipe, b"".join(chunk))
+            except (BlockingIOError, InterruptedError):
+                # A full pipe drops lines, rather than blocking the process
+                with self.dropped.get_lock():
+                    self.dropped.value += len(chunk) + len(lines)
+                return
+            except OSError:
+                return
+
+    def close(self):
+        import os
+        import sys
+
+        self.flush()
+
+        # The writer is a daemon thread, so write out what it hasn't yet
+        if self.reading and (self.reading[0] == os.getpid()):
+            read = self.reading[1]
+            os.set_blocking(read, False)
+            while True:
+                try: data = os.read(read, 65536)
+                except (BlockingIOError, OSError):
+                    break
+                if not data:
+                    break
+                with self.lock:
+                    sys.stdout.write(data.decode("utf-8", "replace"))
+
+    def start(self, filename=None):
+        "Start the writer thread, in the process that owns stdout"
+        import os
+        import threading
+
+        if filename is not None:
+            self.filename = filename
+
+        read, write = os.pipe()
+        os.set_blocking(write, False)
+        self.pipe = write
+        self.reading = (os.getpid(), read)
+
+        writer = threading.Thread(target=self.writer, args=(read,))
+        writer.daemon = True
+        writer.start()
+
+    def writer(self, read):
+        import os
+        import sys
+
+        dropped = 0
+        while True:
+            data = os.read(read, 65536)
+            if not data:
+                break
+
+            text = data.decode("utf-8", "replace")
+            if self.dropped.value != dropped:
+                missing = self.dropped.value - dropped
+                dropped = self.dropped.value
+                text += "Dropped %s log lines\n" % missing
+
+            with self.lock:
+                sys.stdout.write(text)
+            self.rotate()
+
+    def rotate(self):
+        import os
+        import sys
+
+        if (not self.filename) or (self.maximum.value <= 0):
+            return
+
+        try: size = os.fstat(sys.stdout.fileno()).st_size
+        except (OSError, ValueError):
+            return
+        if size < max(self.maximum.value, self.retry):
+            return
+
+        with self.lock:
+            try: self.rotated()
+            except OSError as err:
+                # Writing carries on to the current file, which is reported
+                # once, and rotated again only after it grows by as much
+                if not self.retry:
+                    sys.stdout.write("Warning: Couldn't rotate %s: %s\n" %
+                        (self.filename, err))
+                    sys.stdout.flush()
+                self.retry = size + self.maximum.value
+            else:
+                self.retry = 0
+
+    def rotated(self):
+        import os
+        import sys
+
+        for n in range(self.backups.value - 1, 0, -1):
+            older = "%s.%s" % (self.filename, n)
+            if os.path.exists(older):
+                os.replace(older, "%s.%s" % (self.filename, n + 1))
+
+        if self.backups.value > 0:
+            os.replace(self.filename, self.filename + ".1")
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        descriptor = os.open(self.filename, flags, 0o644)
+        # Other processes keep writing errors to the old file until
+        # they are restarted
+        os.dup2(descriptor, sys.stdout.fileno())
+        os.dup2(descriptor, sys.stderr.fileno())
+        os.close(descriptor)
+
 def populate():
+    global budget
+    global clock
+    global counters
     global filesystem
     global output
 
@@ -57,14 +416,18 @@ def populate():
             yield open(*args, **kargs)
     filesystem.open = filesystem_open
 
-    output = Storage()
+    output = Output()
+    counters = Counters()
 
-    output.lock = multiprocessing.RLock()
+    # Read instead of time.time() by the schedule, pings, command deadlines,
+    # and clock services, so that tests can freeze and advance it
+    clock = Clock()
 
-    def output_write(*args, **kargs):
-        with output.lock:
-            print(*args, **kargs)
-    output.write = output_write
+    # The deadline of the command running in this process, if any
+    budget = Storage()
+    budget.expires = None
+    # Bytes this process has read from web responses, for cost accounting
+    budget.fetched = 0
 
 populate()
 
@@ -94,9 +457,14 @@ def database(base, cache=None):
             with filesystem.open(filename, "rb") as f:
                 return pickle.load(f)
 
+    # Shared, so that any process can see how often the database is written
+    dumps = multiprocessing.Value("q", 0)
+
     def do_dump(name, data):
         with filesystem.open(dotdb % name, "wb") as f:
             pickle.dump(data, f)
+        with dumps.get_lock():
+            dumps.value += 1
 
     # @@ init, copies to cache returns a fallback?
     # e.g. irc.safe.database.init("name", [])
@@ -141,5 +509,6 @@ def database(base, cache=None):
         "dump": dump,
         "context": context,
         "export": export,
-        "cache": cache
+        "cache": cache,
+        "dumps": dumps
     })
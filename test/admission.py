@@ -0,0 +1,87 @@
+# Copyright 2012, Sean B. Palmer
+# Code at http://inamidst.com/duxlot/
+# Apache License 2.0
+
+import collections
+import os
+import sys
+
+if not os.path.isfile("duxlot"):
+    print("Error: Not running in the duxlot directory")
+    sys.exit(1)
+
+sys.path[:0] = [os.getcwd()]
+
+# Save PEP 3122!
+if "." in __name__:
+    from . import process
+else:
+    import process
+
+# Beside this script, in test/
+from harness import check, finish
+
+# Checks the admission queue of process:commands directly: the limits on
+# what one nick and everybody may queue, and the order it serves them in.
+# For example: python3 test/admission.py
+
+def drain(admission, running=None):
+    running = running or collections.Counter()
+    items = []
+    while True:
+        item = admission.next(running)
+        if item is None:
+            return items
+        items.append(item)
+
+def limits():
+    admission = process.Admission(processes=2, user=2, queue=3)
+    added = [admission.add(("#a", "alice"), "alice %s" % i) for i in range(3)]
+    check("nick limited to its queue share", added, [True, True, False])
+
+    # The nick is limited across channels, not per channel
+    check("nick limited across channels",
+        admission.add(("#b", "alice"), "alice #b"), False)
+
+    check("other nick admitted", admission.add(("#a", "bob"), "bob 0"), True)
+    check("queue limited overall", admission.add(("#a", "carol"), "carol 0"),
+        False)
+    check("size counts queued items", admission.size, 3)
+
+    drain(admission)
+    check("room again once drained", admission.add(("#a", "carol"), "carol 0"),
+        True)
+
+def order():
+    admission = process.Admission(processes=2, user=3, queue=36)
+    for i in range(3):
+        admission.add(("#a", "alice"), "alice %s" % i)
+    admission.add(("#a", "bob"), "bob 0")
+    admission.add(("#b", "bob"), "bob #b")
+    admission.add(None, "event")
+
+    check("served round robin by key", drain(admission),
+        ["alice 0", "bob 0", "bob #b", "event", "alice 1", "alice 2"])
+
+def running():
+    admission = process.Admission(processes=2, user=2, queue=36)
+    admission.add(("#a", "alice"), "alice 0")
+    admission.add(("#a", "bob"), "bob 0")
+    admission.add(None, "event")
+
+    busy = collections.Counter({"alice": 2})
+    check("nick at its running limit skipped", drain(admission, busy),
+        ["bob 0", "event"])
+    check("skipped nick still queued", admission.size, 1)
+    check("skipped nick served once below its limit",
+        drain(admission, collections.Counter({"alice": 1})), ["alice 0"])
+
+def main():
+    limits()
+    order()
+    running()
+
+    finish()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# Copyright 2012, Sean B. Palmer
+# Code at http://inamidst.com/duxlot/
+# Apache License 2.0
+
+import os
+import shutil
+import sys
+import tempfile
+
+if not os.path.isfile("duxlot"):
+    print("Error: Not running in the duxlot directory")
+    sys.exit(1)
+
+sys.path[:0] = [os.getcwd()]
+
+import duxlot
+
+# Save PEP 3122!
+if "." in __name__:
+    from . import api
+    from . import bench
+    from . import irc
+    from . import process
+else:
+    import api
+    import bench
+    import irc
+    import process
+
+# Beside this script, in test/
+from harness import check, finish
+
+# Runs process:schedule on a frozen clock, fast-forwarding it through pings,
+# reminders, and command deadlines that would take days in real time. For
+# example: python3 test/clock.py
+
+# 2012-10-12 00:00:00 UTC
+epoch = 1350000000
+
+def services():
+    check("datetime_utc", api.clock.datetime_utc(), "2012-10-12 00:00:00")
+    unixtime = api.clock.periods_unixtime(text="3d 4h").unixtime
+    check("periods_unixtime", unixtime, epoch + (3 * 86400) + (4 * 3600))
+
+def pings(schedule):
+    schedule.taken()
+    schedule.advance(299)
+    check("no ping before 300s", schedule.taken("ping"), [])
+    schedule.advance(1)
+    check("ping at 300s", schedule.taken("ping"), [("ping",)])
+
+    pinged = epoch + 300
+    schedule.advance(59)
+    check("no ponged check before 360s", schedule.taken("ponged"), [])
+    schedule.advance(1)
+    check("ponged check at 360s", schedule.taken("ponged"), [("ponged", pinged)])
+
+    # main_ponged restarts unless a PONG was received after the PING
+    def restarted(ponged):
+        restarts = []
+        client = duxlot.Storage({
+            "public": duxlot.Storage({"data": {"ponged": ponged}}),
+            "main": duxlot.Storage({"restart": lambda: restarts.append(1)})
+        })
+        irc.Client.main_ponged(client, pinged)
+        return len(restarts)
+    check("restart without a PONG", restarted(epoch), 1)
+    check("no restart after a PONG", restarted(pinged + 5), 0)
+
+def reminders(schedule):
+    schedule.taken()
+    due = duxlot.clock.time() + (3 * 86400)
+    schedule.schedule(due, "msg", "#duxlot", "user: Hello")
+    schedule.advance(1)
+    schedule.advance((3 * 86400) - 2)
+    check("no reminder before 3 days", schedule.taken("msg"), [])
+    schedule.advance(1)
+    check("reminder at 3 days", schedule.taken("msg"),
+        [("msg", "#duxlot", "user: Hello")])
+
+def commands(schedule):
+    commands = process.Commands(schedule.harness.manager)
+    now = duxlot.clock.time()
+    commands.known["Command 99999"] = [now, now, now + 60]
+    check("command not collectable before its deadline",
+        commands.collectable(), 0)
+    schedule.advance(61)
+    check("command collectable after its deadline", commands.collectable(), 1)
+
+def budgets(schedule):
+    # A command's own view of its deadline moves with the same clock
+    duxlot.budget.expires = duxlot.clock.time() + 60
+    try:
+        check("budget left before advancing", api.timeout(), 60)
+        schedule.advance(59)
+        check("budget left after advancing", api.timeout(), 1)
+        schedule.advance(1)
+        try: got = api.timeout()
+        except api.Error as err:
+            got = str(err)
+        check("budget spent at its deadline", got, "Ran out of time")
+    finally:
+        duxlot.budget.expires = None
+
+def main():
+    directory = tempfile.mkdtemp(prefix="duxlot-clock-")
+    duxlot.output.configure(level="warning")
+    try:
+        schedule = bench.Scheduler(directory, at=epoch)
+        try:
+            services()
+            pings(schedule)
+            reminders(schedule)
+            commands(schedule)
+            budgets(schedule)
+        finally:
+            schedule.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    finish()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# Copyright 2012, Sean B. Palmer
+# Code at http://inamidst.com/duxlot/
+# Apache License 2.0
+
+import os
+import sys
+
+if not os.path.isfile("duxlot"):
+    print("Error: Not running in the duxlot directory")
+    sys.exit(1)
+
+sys.path[:0] = [os.getcwd()]
+
+# Save PEP 3122!
+if "." in __name__:
+    from . import irc
+else:
+    import irc
+
+# Beside this script, in test/
+from harness import check, finish
+
+# Checks the filter that process:receive drops unwanted lines with, before
+# they are parsed. For example: python3 test/filter.py
+
+def commands():
+    wanted = irc.receive_filter({
+        "commands": ["352", "PING", "PRIVMSG"],
+        "ignore": []
+    })
+    check("allowed command", wanted(b":nick!~u@host PRIVMSG #a :hi\r\n"), True)
+    check("allowed command without a prefix", wanted(b"PING :server\r\n"),
+        True)
+    check("allowed numeric", wanted(b":server 352 duxlot #a u h s n H :0\r\n"),
+        True)
+    check("allowed command in lowercase",
+        wanted(b":nick!~u@host privmsg #a :hi\r\n"), True)
+    check("other command dropped", wanted(b":nick!~u@host MODE #a +o x\r\n"),
+        False)
+    check("other numeric dropped", wanted(b":server 372 duxlot :- MOTD\r\n"),
+        False)
+    # The test server's first line, which process:receive always passes on
+    # for the 1st event, as the filter itself would drop it
+    check("registration notice dropped by the filter",
+        wanted(b":localhost NOTICE * :Test\r\n"), False)
+
+    everything = irc.receive_filter({"commands": ["*"], "ignore": []})
+    check("everything allowed with *", everything(b":server 372 x :-\r\n"),
+        True)
+
+def ignore():
+    wanted = irc.receive_filter({
+        "commands": ["PRIVMSG"],
+        "ignore": ["Spammer!*@*", "*!*@*.example.net", "b?t!*@*"]
+    })
+    check("ignored nick", wanted(b":Spammer!~s@host PRIVMSG #a :hi\r\n"),
+        False)
+    check("ignored nick in another case",
+        wanted(b":SPAMMER!~s@host PRIVMSG #a :hi\r\n"), False)
+    check("ignored host by wildcard",
+        wanted(b":nick!~u@irc.example.net PRIVMSG #a :hi\r\n"), False)
+    check("ignored nick by single character wildcard",
+        wanted(b":bot!~b@host PRIVMSG #a :hi\r\n"), False)
+    check("nick with an ignored one as prefix kept",
+        wanted(b":Spammers!~s@host PRIVMSG #a :hi\r\n"), True)
+    check("other nick kept", wanted(b":nick!~u@host PRIVMSG #a :hi\r\n"),
+        True)
+    check("other host kept",
+        wanted(b":nick!~u@example.net PRIVMSG #a :hi\r\n"), True)
+    check("server prefix never ignored",
+        wanted(b":irc.example.net PRIVMSG duxlot :hi\r\n"), True)
+
+def main():
+    commands()
+    ignore()
+
+    finish()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+# Copyright 2012, Sean B. Palmer
+# Code at http://inamidst.com/duxlot/
+# Apache License 2.0
+
+import sys
+
+# Shared by the scripts under test/ that run checks without a bot, such as
+# test/clock.py. They call check for each result, then finish
+
+# Reprs longer than this are cut short in failure messages
+limit = 160
+
+failures = []
+
+def shorten(value):
+    text = repr(value)
+    if len(text) > limit:
+        return text[:limit] + "..."
+    return text
+
+def check(name, got, expected):
+    if got == expected:
+        print("ok: %s" % name)
+    else:
+        args = (name, shorten(expected), shorten(got))
+        print("FAILED: %s: expected %s, got %s" % args)
+        failures.append(name)
+
+def finish():
+    "Exit with an error if any check failed"
+    if failures:
+        print("Error: %s checks failed" % len(failures))
+        sys.exit(1)
@@ -0,0 +1,102 @@
+# Copyright 2012, Sean B. Palmer
+# Code at http://inamidst.com/duxlot/
+# Apache License 2.0
+
+import argparse
+import os
+import random
+import sys
+
+if not os.path.isfile("duxlot"):
+    print("Error: Not running in the duxlot directory")
+    sys.exit(1)
+
+sys.path[:0] = [os.getcwd()]
+
+# Save PEP 3122!
+if "." in __name__:
+    from . import bench
+else:
+    import bench
+
+# Plays the server side for one bot connection at a set rate, like
+# test/server.py does with scripts, then reports JSON. For example:
+#     python3 test/load.py --rate 500 --duration 60 &
+#     ./duxlot -f start test/test.json
+
+class Load(bench.Session):
+    name = "Load test"
+
+    def play(self, settings, started):
+        chatter = bench.traffic()
+        mix = []
+        for name, weight in settings.mix.items():
+            mix.extend([name] * weight)
+        channels = ["#load%s" % i for i in range(settings.channels)]
+
+        count = int(settings.rate * settings.duration)
+        commands = 0
+        for i in bench.pace(count, settings.rate, started):
+            nick = "user%s" % random.randrange(settings.users)
+            channel = random.choice(channels)
+            prefix = ":%s!~%s@load.example" % (nick, nick)
+
+            if mix and (random.random() * 100 < settings.commands):
+                command = random.choice(mix)
+                if command == "seen":
+                    other = "user%s" % random.randrange(settings.users)
+                    command += " " + other
+                # Stamped just before it's written, and matched on reply
+                self.replies.sent(channel, nick)
+                self.send(prefix, "PRIVMSG", channel, "." + command)
+                commands += 1
+            else:
+                text = chatter[i % len(chatter)]
+                self.send(prefix, "PRIVMSG", channel, text)
+        return {"lines": count, "commands": commands}
+
+    def heard(self, message):
+        if message.get("command") == "PRIVMSG":
+            self.replies.received(*message["parameters"][:2])
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve a load test to one bot connection, and report JSON"
+    )
+    parser.add_argument("--port", type=int, default=61070,
+        help="port to listen on, default 61070 as in test/test.json")
+    parser.add_argument("--rate", type=float, default=200,
+        help="lines per second, default 200")
+    parser.add_argument("--duration", type=float, default=30,
+        help="seconds to send for, default 30")
+    parser.add_argument("--channels", type=int, default=10,
+        help="number of channels, default 10")
+    parser.add_argument("--users", type=int, default=200,
+        help="number of nicks, default 200")
+    parser.add_argument("--commands", type=float, default=5,
+        help="percentage of lines that are commands, default 5")
+    parser.add_argument("--mix", default="stats=1,seen=1",
+        help="command=weight pairs to choose from, default stats=1,seen=1")
+    parser.add_argument("--timeout", type=float, default=300,
+        help="seconds to wait for the bot to catch up, default 300")
+    parser.add_argument("--grace", type=float, default=10,
+        help="seconds to wait for late command replies, default 10")
+    parser.add_argument("--output", default=None,
+        help="file to write the JSON results to, default stdout")
+    settings = parser.parse_args()
+
+    mix = {}
+    for pair in settings.mix.split(","):
+        if pair:
+            name, _, weight = pair.partition("=")
+            mix[name] = int(weight or 1)
+    settings.mix = mix
+
+    results = bench.serve(Load, settings)
+    if results is None:
+        print("Error: The load test didn't complete")
+        sys.exit(1)
+    bench.report(results, settings.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# Copyright 2012, Sean B. Palmer
+# Code at http://inamidst.com/duxlot/
+# Apache License 2.0
+
+import argparse
+import collections
+import os
+import sys
+import time
+
+if not os.path.isfile("duxlot"):
+    print("Error: Not running in the duxlot directory")
+    sys.exit(1)
+
+sys.path[:0] = [os.getcwd()]
+
+# Save PEP 3122!
+if "." in __name__:
+    from . import api
+    from . import bench
+    from . import traffic
+else:
+    import api
+    import bench
+    import traffic
+
+# Replays traffic recorded with the record-traffic option to one bot, at the
+# recorded pace or faster, then reports reply latencies and changes in what
+# the bot said as JSON. With record-web set to replay in the bot's config, web
+# services are answered from the fixtures recorded alongside. For example:
+#     python3 test/replay.py bot.traffic --speed 10 --save said.txt &
+#     ./duxlot -f start test/test.json
+
+def outputs(filename):
+    with open(filename, encoding="utf-8") as f:
+        return [line.rstrip("\n") for line in f]
+
+def compare(expected, got, examples=5):
+    "Lines missing from, and extra to, what the bot said before"
+    expected = collections.Counter(expected)
+    got = collections.Counter(got)
+    missing = list((expected - got).elements())
+    extra = list((got - expected).elements())
+    return {
+        "missing": len(missing),
+        "extra": len(extra),
+        "examples": {
+            "missing": missing[:examples],
+            "extra": extra[:examples]
+        }
+    }
+
+class Replay(bench.Session):
+    name = "Replay"
+
+    def handle(self):
+        self.said = []
+        bench.Session.handle(self)
+
+        settings = self.server.settings
+        results = self.server.results
+        if settings.compare:
+            results["changes"] = compare(outputs(settings.compare), self.said)
+        if settings.save:
+            with open(settings.save, "w", encoding="utf-8") as f:
+                for line in self.said:
+                    f.write(line + "\n")
+
+    def heard(self, message):
+        command = message.get("command")
+        if command in {"PRIVMSG", "NOTICE"}:
+            parameters = message["parameters"]
+            self.said.append(" ".join([command] + parameters[:1]) +
+                " :" + " ".join(parameters[1:]))
+            if command == "PRIVMSG":
+                self.replies.received(*parameters[:2])
+
+    def play(self, settings, started):
+        "Send the recording, noting the lines sent, commands, and duration"
+        sent = 0
+        commands = 0
+        first = last = None
+        for stamp, octets in traffic.read(settings.recording):
+            try: message = api.irc.parse_message(octets=octets)()
+            except api.Error:
+                continue
+
+            # Pings would be mistaken for the drain, and errors end sessions
+            command = message.get("command")
+            if command in {"PING", "PONG", "ERROR"}:
+                continue
+
+            if first is None:
+                first = stamp
+            last = stamp
+            if settings.speed:
+                ahead = started + ((stamp - first) / settings.speed)
+                ahead -= time.time()
+                if ahead > 0:
+                    time.sleep(ahead)
+
+            parameters = message["parameters"]
+            if (command == "PRIVMSG") and (len(parameters) > 1):
+                target, text = parameters[:2]
+                if text.startswith(settings.prefix):
+                    nick = message["prefix"]["nick"]
+                    # Private commands are replied to privately
+                    if not target.startswith(("#", "&")):
+                        target = nick
+                    self.replies.sent(target, nick)
+                    commands += 1
+
+            self.write(octets.rstrip(b"\r\n"))
+            sent += 1
+
+        recorded = (last - first) if (first is not None) else 0
+        return {"lines": sent, "commands": commands, "recorded": recorded}
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay recorded traffic to one bot connection"
+    )
+    parser.add_argument("recording",
+        help="file written by the bot with the record-traffic option")
+    parser.add_argument("--port", type=int, default=61070,
+        help="port to listen on, default 61070 as in test/test.json")
+    parser.add_argument("--speed", type=float, default=1,
+        help="multiple of the recorded pace, or 0 for maximum, default 1")
+    parser.add_argument("--prefix", default=".",
+        help="prefix of commands, for matching replies, default .")
+    parser.add_argument("--window", type=float, default=30,
+        help="seconds after which a command has no reply, default 30")
+    parser.add_argument("--save", default=None,
+        help="file to save what the bot said to, for a later --compare")
+    parser.add_argument("--compare", default=None,
+        help="file saved by an earlier --save, to compare what was said")
+    parser.add_argument("--timeout", type=float, default=300,
+        help="seconds to wait for the bot to catch up, default 300")
+    parser.add_argument("--grace", type=float, default=10,
+        help="seconds to wait for late command replies, default 10")
+    parser.add_argument("--output", default=None,
+        help="file to write the JSON results to, default stdout")
+    settings = parser.parse_args()
+
+    results = bench.serve(Replay, settings)
+    if results is None:
+        print("Error: The replay didn't complete")
+        sys.exit(1)
+    bench.report(results, settings.output)
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,18 @@
 # Code at http://inamidst.com/duxlot/
 # Apache License 2.0
 
-import multiprocessing
+import argparse
+import json
 import os
+import queue
 import re
+import shutil
 import socket
 import socketserver
+import subprocess
 import sys
+import tempfile
+import threading
 import time
 
 if not os.path.isfile("duxlot"):
@@ -19,8 +25,10 @@ sys.path[:0] = [os.getcwd()]
 # Save PEP 3122!
 if "." in __name__:
     from . import api
+    from . import bench
 else:
     import api
+    import bench
 
 connections = 0
 test_counter = 0
@@ -34,6 +42,9 @@ def test(test_function):
 
     test_counter += 1
     decorated.number = test_counter
+    # Tests run straight after the previous one, on the same bot, when they
+    # depend on what it did. In combined.txt, such tests start with AFTER
+    decorated.after = getattr(test_function, "after", False)
     tests[decorated.number] = decorated
     return decorated
 
@@ -71,17 +82,28 @@ for lines in text.split("\n\n"):
         # if not lines.startswith(".tw"):
         #     return
 
+        after = lines.startswith("AFTER\n")
+        if after:
+            lines = lines.split("\n", 1).pop()
+
         # @@ expected
-        @test
         def test_function(conn):
             conn.handshake()
     
             for line in lines.split("\n"):
                 line = line.replace("$(BOT)", "duxlot")
                 line = line.replace("$(USER)", "user")
+                line = line.replace("$(ADMIN)", "admin01")
     
                 if line.startswith("."):
                     conn.send(":user!~user@localhost", "PRIVMSG", "#duxlot", line)
+                elif line.startswith("ADMIN "):
+                    line = line.split(" ", 1).pop()
+                    conn.send(":admin01!~admin01@localhost", "PRIVMSG", "#duxlot", line)
+                elif line.startswith("IGNORED "):
+                    # Matches the ignore option of test/test.json
+                    line = line.split(" ", 1).pop()
+                    conn.send(":Ignored!~ignored@localhost", "PRIVMSG", "#duxlot", line)
                 elif line == "TIMEOUT":
                     conn.nowt()
                 elif line.startswith("WAIT "):
@@ -110,6 +132,8 @@ for lines in text.split("\n\n"):
                     else:
                         conn.equal(line, got, "Expected %r, got %r" % (line, got))
                 # @@ then a nowt?
+        test_function.after = after
+        test(test_function)
     build(lines[:])
 
 # @test
@@ -147,38 +171,37 @@ class Test(socketserver.StreamRequestHandler):
     timeout = 6
 
     def handle(self, *args, **kargs):
-        global connections, test_counter
-
-        connections += 1
-        self.connection = connections
+        self.number = self.server.next_test()
         self.messages = 0
 
         # print(dir(self.server))
-        self.send(":localhost", "NOTICE", "*", "Test #%s" % self.connection)
+        self.send(":localhost", "NOTICE", "*", "Test #%s" % self.number)
+
+        if self.number in tests:
+            self.report("Test #%s" % self.number)
+            try: tests[self.number](self)
+            finally:
+                self.server.done(self, self.number)
 
-        if self.connection in tests:
-            print("Test #%s" % self.connection)
-            tests[self.connection](self)
+    def report(self, text):
+        self.server.report(self.number, text)
 
-            # print(self.connection, test_counter)
-            if self.connection == test_counter:
-                print("Tests complete")
-                self.finish()
-                os._exit(0)
+    def error(self, message):
+        self.report("ERROR: Test #%s: %s" % (self.number, message))
 
     def match(self, a, b, message):
         if not re.match(a, b):
-            print("ERROR: Test #%s: %s" % (self.connection, message))
+            self.error(message)
             self.stop()
 
     def equal(self, a, b, message):
         if a != b:
-            print("ERROR: Test #%s: %s" % (self.connection, message))
+            self.error(message)
             self.stop()
 
     def not_equal(self, a, b, message):
         if a == b:
-            print("ERROR: Test #%s: %s" % (self.connection, message))
+            self.error(message)
             self.stop()
 
     def stop(self):
@@ -200,7 +223,12 @@ class Test(socketserver.StreamRequestHandler):
     def recv(self):
         try: octets = self.rfile.readline()
         except socket.timeout:
-            print("ERROR: Test #%s: timeout" % self.connection)
+            self.error("timeout")
+            self.stop()
+        except socket.error:
+            octets = b""
+        if not octets:
+            self.error("disconnected")
             self.stop()
 
         o = api.irc.parse_message(octets=octets)
@@ -212,10 +240,12 @@ class Test(socketserver.StreamRequestHandler):
         try: octets = self.rfile.readline()
         except socket.timeout:
             return True
+        except socket.error:
+            self.error("disconnected")
+            self.stop()
         else:
             text = octets.decode("utf-8", "replace")
-            args = (self.connection, text)
-            print("ERROR: Test #%s: Expected timeout, got %r" % args)
+            self.error("Expected timeout, got %r" % text)
 
     def send(self, *args):
         args = list(args)
@@ -226,8 +256,12 @@ class Test(socketserver.StreamRequestHandler):
         octets = octets.replace(b"\n", b"")
         if len(octets) > 510:
             octets = octets[:510]
-        self.wfile.write(octets + b"\r\n")
-        self.wfile.flush()
+        try:
+            self.wfile.write(octets + b"\r\n")
+            self.wfile.flush()
+        except socket.error:
+            self.error("disconnected")
+            self.stop()
 
     # def user
     # def channel
@@ -242,7 +276,23 @@ class Test(socketserver.StreamRequestHandler):
             ...
 
 class Server(socketserver.TCPServer):
-    ...
+    "Runs every test in order, one per connection, against an external bot"
+
+    def next_test(self):
+        global connections
+
+        connections += 1
+        return connections
+
+    def report(self, number, text):
+        print(text)
+
+    def done(self, conn, number):
+        # print(number, test_counter)
+        if number == test_counter:
+            print("Tests complete")
+            conn.finish()
+            os._exit(0)
 
     # @@ if SystemExit, fine, otherwise raise it and os._exit(1)
     def handle_error(self, request, client_address):
@@ -255,9 +305,172 @@ class Server(socketserver.TCPServer):
         traceback.print_exc()
         os._exit(1)
 
+class Instance(Server):
+    """Starts a bot of its own, in a directory of its own, and runs chains of
+    tests from a queue shared with other instances, collecting the output"""
+    allow_reuse_address = True
+    # Seconds between checks that the bot is still alive, when waiting for
+    # it to connect, and the most to wait before giving up on it
+    timeout = 5
+    patience = 60
+
+    def __init__(self, chains, results):
+        Server.__init__(self, ("localhost", 0), Test)
+        self.chains = chains
+        self.results = results
+        self.chain = []
+        self.ran = []
+        self.finished = False
+        self.waited = 0
+        self.failure = None
+
+        self.directory = tempfile.mkdtemp(prefix="duxlot-test-")
+        with open("test/test.json", encoding="utf-8") as f:
+            config = json.load(f)
+        config["address"] = "localhost:%s" % self.server_address[1]
+        self.config = os.path.join(self.directory, "test.json")
+        with open(self.config, "w", encoding="utf-8") as f:
+            json.dump(config, f, indent=4)
+
+        self.log = os.path.join(self.directory, "bot.log")
+        with open(self.log, "wb") as log:
+            # In its own session, so its processes can be killed together
+            self.bot = subprocess.Popen(
+                [sys.executable, "duxlot", "-f", "start", self.config],
+                stdout=log, stderr=subprocess.STDOUT, start_new_session=True
+            )
+
+    def next_test(self):
+        if not self.chain:
+            try: self.chain = list(self.chains.get_nowait())
+            except queue.Empty:
+                return quit.number
+        return self.chain.pop(0)
+
+    def report(self, number, text):
+        # Every bot runs the quit test, which isn't reported
+        if number == quit.number:
+            return
+        if number not in self.results:
+            self.ran.append(number)
+        self.results.setdefault(number, []).append(text)
+
+    def done(self, conn, number):
+        if number == quit.number:
+            self.finished = True
+
+    def finish_request(self, request, client_address):
+        self.waited = 0
+        # A failed test stops its own connection, not the rest of the run
+        try: Server.finish_request(self, request, client_address)
+        except SystemExit:
+            ...
+
+    def handle_timeout(self):
+        self.waited += self.timeout
+
+    def fail(self, message):
+        "Fail the bot, and the rest of the chain, which it can't run"
+        self.failure = message
+        for number in self.chain:
+            self.report(number, "Test #%s" % number)
+            self.report(number, "ERROR: Test #%s: %s" % (number, message))
+        self.chain = []
+
+    def run(self):
+        while not self.finished:
+            self.handle_request()
+            if self.finished:
+                break
+            if self.bot.poll() is not None:
+                self.fail("The bot exited with %s" % self.bot.returncode)
+                break
+            if self.waited >= self.patience:
+                self.fail("The bot didn't connect within %ss" % self.patience)
+                break
+
+        def exited():
+            try: self.bot.wait(10)
+            except subprocess.TimeoutExpired:
+                return False
+            return True
+        bench.stop(self.bot.pid, exited)
+        self.bot.wait()
+        self.server_close()
+
+def parallel(jobs):
+    "Run the tests across this many bots at once, then report in order"
+    started = time.time()
+
+    chains = queue.Queue()
+    chain = []
+    for number in sorted(tests):
+        if number == quit.number:
+            continue
+        if chain and not tests[number].after:
+            chains.put(chain)
+            chain = []
+        chain.append(number)
+    if chain:
+        chains.put(chain)
+
+    results = {}
+    instances = [Instance(chains, results) for job in range(jobs)]
+    threads = [threading.Thread(target=instance.run) for instance in instances]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Chains left when every bot has died or stalled
+    for number in sorted(tests):
+        if (number != quit.number) and (number not in results):
+            results[number] = [
+                "Test #%s" % number,
+                "ERROR: Test #%s: Not run, as no bot was left" % number
+            ]
+
+    failures = set()
+    for number in sorted(results):
+        lines = results[number]
+        for line in lines:
+            print(line)
+        if any(line.startswith("ERROR:") for line in lines):
+            failures.add(number)
+
+    kept = []
+    for instance in instances:
+        # The directories of bots with failures are kept for their logs
+        if instance.failure or failures.intersection(instance.ran):
+            kept.append(instance.log)
+        else:
+            shutil.rmtree(instance.directory, ignore_errors=True)
+
+    failed = len(failures)
+    args = (len(results), failed, jobs, round(time.time() - started, 1))
+    print("Tests complete: %s run, %s failed, with %s bots in %ss" % args)
+    broken = [instance for instance in instances if instance.failure]
+    for instance in broken:
+        print("ERROR: Bot failed: %s" % instance.failure)
+    for log in kept:
+        print("Log kept: %s" % log)
+    return (failed == 0) and (not broken)
+
 def main():
-    server = Server(("", 61070), Test)
-    server.serve_forever()
+    parser = argparse.ArgumentParser(
+        description="Serve the functional tests to duxlot bots"
+    )
+    parser.add_argument("--jobs", type=int, default=None,
+        help="start this many bots, and share the tests between them. "
+            "Otherwise, wait for one bot to connect on port 61070")
+    args = parser.parse_args()
+
+    if args.jobs is None:
+        server = Server(("", 61070), Test)
+        server.serve_forever()
+    else:
+        passed = parallel(max(args.jobs, 1))
+        sys.exit(0 if passed else 1)
 
 if __name__ == "__main__":
     main()
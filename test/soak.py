@@ -0,0 +1,270 @@
+# Copyright 2012, Sean B. Palmer
+# Code at http://inamidst.com/duxlot/
+# Apache License 2.0
+
+import argparse
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+if not os.path.isfile("duxlot"):
+    print("Error: Not running in the duxlot directory")
+    sys.exit(1)
+
+sys.path[:0] = [os.getcwd()]
+
+# Save PEP 3122!
+if "." in __name__:
+    from . import api
+    from . import bench
+    from . import metrics
+    from . import process
+else:
+    import api
+    import bench
+    import metrics
+    import process
+
+# Streams synthetic traffic at the bot, as test/server.py does with scripts,
+# and fails if the RSS of any of its processes grows by more than a budget.
+# With --trace, the bot runs under tracemalloc, and the allocations that
+# grew the most in each pipeline process are shown at the end
+
+def traced(filename):
+    # Forked processes carry on tracing
+    tracemalloc.start()
+    bench.client(filename)
+
+def traffic(count, commands):
+    "Lines of chatter, joins and parts, and commands from many nicks"
+    chatter = bench.traffic()
+    for i in range(count):
+        nick = "soak%s" % (i % 500)
+        prefix = ":%s!~%s@soak.example" % (nick, nick)
+        kind = i % 100
+        if kind < commands:
+            if i % 2:
+                text = ".stats"
+            else:
+                text = ".seen soak%s" % ((i * 7) % 500)
+            line = "%s PRIVMSG #duxlot :%s" % (prefix, text)
+        elif kind < (commands + 5):
+            line = "%s JOIN #soak%s" % (prefix, i % 20)
+        elif kind < (commands + 10):
+            line = "%s PART #soak%s :Bye" % (prefix, i % 20)
+        else:
+            text = chatter[i % len(chatter)]
+            line = "%s PRIVMSG #duxlot :%s" % (prefix, text)
+        yield line.encode("utf-8") + b"\r\n"
+
+class Soak(bench.Server):
+    def __init__(self, options, trace=False):
+        bench.Server.__init__(self, options, traced if trace else bench.client)
+        self.sending = threading.Lock()
+        self.replies = queue.Queue()
+        self.pongs = queue.Queue()
+        self.monitor = metrics.Monitor(length=2)
+
+    def send(self, *args):
+        with self.sending:
+            bench.Server.send(self, *args)
+
+    def sendall(self, octets):
+        with self.sending:
+            self.connection.sendall(octets)
+
+    def read(self):
+        "Drain the bot's output, answering its pings"
+        self.connection.settimeout(None)
+        while True:
+            octets = self.rfile.readline()
+            if not octets:
+                break
+            message = api.irc.parse_message(octets=octets)()
+            command = message.get("command")
+            if command == "PING":
+                self.send("PONG", message["parameters"][-1])
+            elif command == "PONG":
+                self.pongs.put(message["parameters"][-1])
+            elif command == "PRIVMSG":
+                if message["parameters"][0] == "owner":
+                    self.replies.put(message["parameters"][1])
+
+    def start(self):
+        self.handshake()
+        thread = threading.Thread(target=self.read)
+        thread.daemon = True
+        thread.start()
+
+    def drain(self, timeout=300):
+        "Wait until the bot has handled everything sent so far"
+        # The bot answers pings in order, but not with their parameter
+        self.send("PING", "drain")
+        self.pongs.get(timeout=timeout)
+
+    def pids(self):
+        "Map the names of the bot's processes to their PIDs"
+        while not self.replies.empty():
+            self.replies.get()
+        self.send(":owner!~owner@localhost", "PRIVMSG", "duxlot", ".pids")
+        # Addressed as "owner: receive: <pid>, send: <pid>, ..."
+        reply = self.replies.get(timeout=30).split(": ", 1).pop()
+
+        pids = {"main": self.bot.pid}
+        for pair in reply.split(", "):
+            name, pid = pair.split(": ")
+            pids[name] = int(pid)
+
+        # The manager is the oldest child that isn't a pipeline process
+        known = set(pids.values())
+        children = []
+        for pid in bench.tree(self.bot.pid):
+            try: fields = metrics.stat(pid)
+            except (IOError, OSError):
+                continue
+            if (int(fields[1]) == self.bot.pid) and (pid not in known):
+                children.append((int(fields[19]), pid))
+        if children:
+            pids["manager"] = min(children)[1]
+        return pids
+
+    def sample(self, pids):
+        self.monitor.sample(pids)
+        return {name: self.monitor.latest(name)[2]
+            for name in self.monitor.history}
+
+    def snapshots(self, pids):
+        "Have each pipeline process dump a tracemalloc snapshot, and load it"
+        snapshots = {}
+        for name, pid in pids.items():
+            if name in {"main", "manager"}:
+                continue
+            filename = process.snapshot_filename(pid)
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.kill(pid, signal.SIGUSR2)
+
+            for attempt in range(100):
+                if os.path.exists(filename):
+                    break
+                time.sleep(0.1)
+            else:
+                continue
+            snapshots[name] = tracemalloc.Snapshot.load(filename)
+            os.remove(filename)
+        return snapshots
+
+def megabytes(octets):
+    return round(octets / 1048576, 1)
+
+def soak(count, rate, commands, budget, interval, warmup, trace):
+    server = Soak({}, trace=trace)
+    try:
+        server.start()
+        lines = traffic(count, commands)
+        pids = None
+        baseline = None
+        snapshots = {}
+
+        started = time.time()
+        reported = started
+        for i, octets in zip(bench.pace(count, rate, started), lines):
+            server.sendall(octets)
+
+            if i == warmup:
+                server.drain()
+                pids = server.pids()
+                # Taking a snapshot raises RSS for good, so it's done first
+                if trace:
+                    snapshots = server.snapshots(pids)
+                baseline = server.sample(pids)
+                sizes = ", ".join("%s %sMB" % (name, megabytes(rss))
+                    for name, rss in baseline.items())
+                print("Baseline after %s lines: %s" % (warmup, sizes))
+
+            if (time.time() - reported) >= interval:
+                reported = time.time()
+                achieved = round(i / (reported - started))
+                if pids is not None:
+                    sizes = ", ".join("%s %sMB" % (name, megabytes(rss))
+                        for name, rss in server.sample(pids).items())
+                else:
+                    sizes = "warming up"
+                print("%s lines, %s/s: %s" % (i, achieved, sizes))
+                sys.stdout.flush()
+
+        server.drain()
+        if pids is None:
+            print("Error: Fewer lines than the warmup, so nothing to compare")
+            return False
+
+        final = server.sample(pids)
+        failed = []
+        for name, rss in final.items():
+            growth = rss - baseline.get(name, rss)
+            status = "ok"
+            if growth > (budget * 1048576):
+                status = "FAILED"
+                failed.append(name)
+            args = (name, megabytes(baseline.get(name, rss)),
+                megabytes(rss), megabytes(growth), status)
+            print("%s: %sMB to %sMB, %+.1fMB, %s" % args)
+
+        for name in pids:
+            if name not in final:
+                print("%s: exited, or was restarted, during the soak" % name)
+                failed.append(name)
+
+        if trace:
+            for name, snapshot in server.snapshots(pids).items():
+                if name not in snapshots:
+                    continue
+                print("Largest allocation growth in %s:" % name)
+                differences = snapshot.compare_to(snapshots[name], "lineno")
+                for difference in differences[:5]:
+                    print("    %s" % difference)
+
+        duration = time.time() - started
+        print("Sent %s lines in %ss" % (count, round(duration)))
+        if failed:
+            msg = "Error: RSS grew by more than %sMB in %s"
+            print(msg % (budget, ", ".join(failed)))
+            return False
+        return True
+    finally:
+        server.close()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Soak test the bot with synthetic traffic"
+    )
+    parser.add_argument("--lines", type=int, default=1000000,
+        help="number of lines to send, default 1000000")
+    parser.add_argument("--rate", type=int, default=2000,
+        help="lines per second, default 2000")
+    parser.add_argument("--commands", type=int, default=1,
+        help="percentage of lines that are commands, default 1")
+    parser.add_argument("--budget", type=float, default=16,
+        help="megabytes that any process may grow by, default 16")
+    parser.add_argument("--interval", type=float, default=10,
+        help="seconds between reports, default 10")
+    parser.add_argument("--warmup", type=int, default=None,
+        help="lines sent before the baseline, default a tenth")
+    parser.add_argument("--trace", action="store_true",
+        help="compare tracemalloc snapshots, which is much slower")
+    args = parser.parse_args()
+
+    warmup = args.warmup
+    if warmup is None:
+        warmup = args.lines // 10
+
+    passed = soak(args.lines, args.rate, args.commands, args.budget,
+        args.interval, warmup, args.trace)
+    sys.exit(0 if passed else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+# Copyright 2012, Sean B. Palmer
+# Code at http://inamidst.com/duxlot/
+# Apache License 2.0
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import urllib.error
+import zlib
+
+if not os.path.isfile("duxlot"):
+    print("Error: Not running in the duxlot directory")
+    sys.exit(1)
+
+sys.path[:0] = [os.getcwd()]
+
+# Save PEP 3122!
+if "." in __name__:
+    from . import api
+    from . import duxlot
+else:
+    import api
+    import duxlot
+
+# Beside this script, in test/
+from harness import check, finish
+
+# Checks the web cache, the coalescing of fetches, and decompression against
+# fakes, so no network is needed. For example: python3 test/web.py
+
+url = "http://example.org/moved"
+
+@api.service(api.web)
+def transport_fake(args):
+    # Redirects when not following them, like transport_live
+    transport_fake.calls.value += 1
+    time.sleep(transport_fake.delay)
+    if transport_fake.reply is not None:
+        return transport_fake.reply(args.request)
+    if args("follow"):
+        status, location = 200, url + "/here"
+    else:
+        status, location = 301, url
+    return api.Fixture({
+        "status": status,
+        "url": location,
+        "headers": [("Cache-Control", "max-age=60"), ("Location", url)],
+        "body": b"Moved"
+    })
+# Shared, so that fetches in other processes are counted
+transport_fake.calls = multiprocessing.Value("i", 0)
+transport_fake.delay = 0
+# Replaces the redirects with a function of the request, when set
+transport_fake.reply = None
+
+def reply(status, headers, body=b"Body"):
+    return api.Fixture({
+        "status": status,
+        "url": url,
+        "headers": headers,
+        "body": body
+    })
+
+def fresh():
+    # Empties the cache and its counts, for checks that count fetches
+    directory = api.web.options.cache_directory
+    shutil.rmtree(directory, ignore_errors=True)
+    api.web.options.cache_statistics = {}
+    transport_fake.calls.value = 0
+
+def statistic(name):
+    return getattr(api.web.cache_statistics(), name)
+
+def cache():
+    fresh()
+
+    page = api.web.request(url=url)
+    check("status without follow", page.status, 301)
+    page = api.web.request(url=url, follow=True)
+    check("status with follow", page.status, 200)
+    check("separate fetches with and without follow",
+        transport_fake.calls.value, 2)
+
+    api.web.request(url=url, follow=True)
+    check("cached with follow", transport_fake.calls.value, 2)
+
+def expiry():
+    fresh()
+    transport_fake.reply = lambda request: reply(200,
+        [("Cache-Control", "max-age=10")])
+    duxlot.clock.freeze()
+    try:
+        api.web.request(url=url)
+        duxlot.clock.advance(9)
+        api.web.request(url=url)
+        check("fresh until max-age", transport_fake.calls.value, 1)
+
+        duxlot.clock.advance(2)
+        api.web.request(url=url)
+        check("fetched again after max-age", transport_fake.calls.value, 2)
+
+        api.web.request(url=url, ttl=100)
+        duxlot.clock.advance(50)
+        api.web.request(url=url, ttl=100)
+        check("ttl overrides max-age", transport_fake.calls.value, 3)
+    finally:
+        duxlot.clock.thaw()
+        transport_fake.reply = None
+
+def revalidation():
+    def revalidate(request):
+        if request.get_header("If-none-match") == '"one"':
+            return reply(304, [("Cache-Control", "max-age=10")], b"")
+        return reply(200, [("Cache-Control", "no-cache"), ("ETag", '"one"')])
+
+    fresh()
+    transport_fake.reply = revalidate
+    duxlot.clock.freeze()
+    try:
+        api.web.request(url=url)
+        page = api.web.request(url=url)
+        check("revalidated with If-None-Match",
+            (page.status, page.octets, statistic("revalidated")),
+            (200, b"Body", 1))
+
+        api.web.request(url=url)
+        check("fresh for the max-age given in a 304",
+            transport_fake.calls.value, 2)
+
+        duxlot.clock.advance(11)
+        api.web.request(url=url)
+        check("revalidated again after that max-age",
+            (transport_fake.calls.value, statistic("revalidated")), (3, 2))
+    finally:
+        duxlot.clock.thaw()
+        transport_fake.reply = None
+
+def negative():
+    def unreachable(request):
+        raise urllib.error.URLError("Unreachable")
+
+    fresh()
+    transport_fake.reply = lambda request: reply(404, [], b"Not Found")
+    try:
+        statuses = [api.web.request(url=url).status for attempt in range(2)]
+        check("missing pages cached", (statuses, transport_fake.calls.value),
+            ([404, 404], 1))
+
+        transport_fake.reply = unreachable
+        errors = []
+        for attempt in range(2):
+            try: api.web.request(url=url + "/unreachable")
+            except urllib.error.URLError as err:
+                errors.append(str(err.reason))
+        check("errors cached",
+            (errors, transport_fake.calls.value, statistic("negative")),
+            (["Unreachable", "Unreachable"], 2, 1))
+    finally:
+        transport_fake.reply = None
+
+def private():
+    fresh()
+    transport_fake.reply = lambda request: reply(200,
+        [("Cache-Control", "private, max-age=60")])
+    try:
+        api.web.request(url=url)
+        api.web.request(url=url)
+        check("private responses not stored", transport_fake.calls.value, 2)
+    finally:
+        transport_fake.reply = None
+
+def eviction():
+    fresh()
+    transport_fake.reply = lambda request: reply(200,
+        [("Cache-Control", "max-age=60")])
+    options = api.web.options
+    files, size, prune = options.cache_files, options.cache_size, \
+        options.cache_prune
+    options.cache_files, options.cache_prune = 3, 1
+    try:
+        for name in ("a", "b", "c", "a", "d"):
+            api.web.request(url=url + "/" + name)
+            # Pruning goes by mtime, so keep the uses apart
+            time.sleep(0.02)
+        check("pruned to the file bound", statistic("entries"), 3)
+
+        transport_fake.calls.value = 0
+        api.web.request(url=url + "/a")
+        check("recently used entry kept", transport_fake.calls.value, 0)
+        api.web.request(url=url + "/b")
+        check("least recently used entry evicted",
+            transport_fake.calls.value, 1)
+
+        options.cache_files, options.cache_size = 100, 0
+        api.web.request(url=url + "/e")
+        check("pruned to the size bound", statistic("entries"), 0)
+    finally:
+        options.cache_files, options.cache_size = files, size
+        options.cache_prune = prune
+        transport_fake.reply = None
+
+def coalesce(directory):
+    def fetch(results, index, follow):
+        params = {"url": url, "cache": False}
+        if follow:
+            params["follow"] = True
+        results.put((index, api.web.request(**params).status))
+
+    api.flight.directory = os.path.join(directory, "flight")
+    transport_fake.calls.value = 0
+    transport_fake.delay = 0.5
+    try:
+        # Fetched at once, so identical requests share one flight
+        results = multiprocessing.Queue()
+        follows = [False, True, False, True]
+        processes = [multiprocessing.Process(target=fetch,
+            args=(results, index, follow))
+            for index, follow in enumerate(follows)]
+        for process in processes:
+            process.start()
+        statuses = dict(results.get(timeout=30) for process in processes)
+        for process in processes:
+            process.join()
+    finally:
+        api.flight.directory = None
+        transport_fake.delay = 0
+
+    check("coalesced statuses with and without follow",
+        [statuses[index] for index in range(len(follows))],
+        [301, 200, 301, 200])
+    check("one flight each with and without follow",
+        transport_fake.calls.value, 2)
+
+class Trickle(object):
+    "Response that gives a byte per read, as a slow server might"
+
+    def __init__(self, octets):
+        self.octets = octets
+
+    def read1(self, amount):
+        byte, self.octets = self.octets[:1], self.octets[1:]
+        return byte
+
+def decompression():
+    text = b"<title>Trickled</title>" * 100
+    encodings = [
+        ("gzip", 16 + zlib.MAX_WBITS),
+        ("deflate", zlib.MAX_WBITS),
+        ("deflate", -zlib.MAX_WBITS)
+    ]
+    for coding, wbits in encodings:
+        compressor = zlib.compressobj(wbits=wbits)
+        octets = compressor.compress(text) + compressor.flush()
+        name = "%s with wbits %s, a byte at a time" % (coding, wbits)
+        try: got = api.web.read(response=Trickle(octets), coding=coding)
+        except Exception as err:
+            got = err
+        check(name, got, text)
+
+def main():
+    directory = tempfile.mkdtemp(prefix="duxlot-web-")
+    api.web.options.transport = "fake"
+    api.web.options.cache_directory = os.path.join(directory, "cache")
+    try:
+        cache()
+        expiry()
+        revalidation()
+        negative()
+        private()
+        eviction()
+        coalesce(directory)
+        decompression()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    finish()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# Copyright 2012, Sean B. Palmer
+# Code at http://inamidst.com/duxlot/
+# Apache License 2.0
+
+import multiprocessing
+
+# Save PEP 3122!
+if "." in __name__:
+    from . import storage
+else:
+    import storage
+
+# Recordings have a line per received line, prefixed by when it was received
+# in seconds since the epoch and a space, as in "1350000000.123 :nick!..."
+# Lines are recorded before they're filtered, so replays see everything
+
+class Recording(object):
+    "Writes the lines that process:receive gets, and when, to a file"
+
+    def __init__(self, interval=1):
+        # Flushed at most this often, as a write per line would be slow
+        self.interval = interval
+        # Shared, so that the option takes effect without a reconnection
+        self.enabled = multiprocessing.Value("b", 0, lock=False)
+        self.filename = None
+        self.reset()
+        storage.after_fork(self.reset)
+
+    def reset(self):
+        # Only the process that opened the file may write to it
+        self.file = None
+        self.flushed = 0.0
+
+    def configure(self, enabled=None):
+        if enabled is not None:
+            self.enabled.value = 1 if enabled else 0
+
+    def write(self, stamp, octets):
+        if not self.enabled.value:
+            if self.file is not None:
+                self.close()
+            return
+
+        if self.filename is None:
+            return
+        if self.file is None:
+            self.file = open(self.filename, "ab")
+
+        if not octets.endswith(b"\n"):
+            octets += b"\r\n"
+        self.file.write(("%.3f " % stamp).encode("ascii") + octets)
+        if (stamp - self.flushed) >= self.interval:
+            self.file.flush()
+            self.flushed = stamp
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+recording = Recording()
+
+def read(filename):
+    "Yield the (stamp, octets) pairs of a recording"
+    with open(filename, "rb") as f:
+        for line in f:
+            stamp, octets = line.split(b" ", 1)
+            yield float(stamp), octets